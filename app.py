@@ -1,19 +1,113 @@
-import os, sys, json
+import os, sys, json, threading, base64
 from functools import wraps
+from Queue import Empty
 
-from flask import Flask, request, render_template, g, jsonify, session, redirect, Response
+from flask import Flask, Request, request, render_template, g, jsonify, session, redirect, url_for, Response
 from werkzeug import secure_filename
-from peewee import SQL
-import soco
+from werkzeug.datastructures import ContentRange
+from werkzeug.wsgi import wrap_file
+
+from controller import Controller, QUEUE_WINDOW
+from pool import PoolExhausted
+from ingest import Ingester, IngestError, StagedUpload
+from passwords import PasswordHasher, HasherBusy, BCRYPT_ROUNDS, HASH_PROCESSES
+import search
+from sonos import SonosRegistry
+from cache import LRUCache
+from db import MUSIC_DIR, DB_PATH, init_db, User, Song, Playlist, PlaylistEntry
+
+class JuiceBoxRequest(Request):
+    """
+    Song uploads are parsed straight into the ingest staging area, hashing
+    them on the way, instead of into a temporary file which is then copied.
+    """
+    def __init__(self, *args, **kwargs):
+        Request.__init__(self, *args, **kwargs)
+        self.staged_uploads = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint != "route_upload":
+            return Request._get_file_stream(self, total_content_length, content_type,
+                filename, content_length)
 
-from controller import Controller
-from db import MUSIC_DIR, User, Song, FTSSong, Playlist, FTSPlaylist
+        staged = StagedUpload()
+        self.staged_uploads.append(staged)
+        return staged
 
-app = Flask("juicebox")
+class JuiceBox(Flask):
+    """
+    Services which talk to the outside world (MPD) are only created the first
+    time they are used, so importing the app stays cheap.
+    """
+    request_class = JuiceBoxRequest
+
+    def __init__(self, *args, **kwargs):
+        Flask.__init__(self, *args, **kwargs)
+        self._controller = None
+        self._hasher = None
+        self._sonos = None
+        self.services_lock = threading.Lock()
+        self.ingester = Ingester()
+
+    @property
+    def controller(self):
+        if not self._controller:
+            with self.services_lock:
+                if not self._controller:
+                    self._controller = Controller(self.config["MPD_HOST"])
+        return self._controller
+
+    @property
+    def hasher(self):
+        if not self._hasher:
+            with self.services_lock:
+                if not self._hasher:
+                    self._hasher = PasswordHasher(self.config["BCRYPT_ROUNDS"],
+                        self.config["HASH_PROCESSES"])
+        return self._hasher
+
+    @property
+    def sonos(self):
+        if not self._sonos:
+            with self.services_lock:
+                if not self._sonos:
+                    self._sonos = SonosRegistry(interface_addr=self.config["SONOS_INTERFACE"])
+        return self._sonos
+
+app = JuiceBox("juicebox")
 app.secret_key = "swag"
-app.controller = Controller()
+app.config.update(
+    MPD_HOST="/run/mpd/socket",
+    DATABASE=DB_PATH,
+    BCRYPT_ROUNDS=BCRYPT_ROUNDS,
+    HASH_PROCESSES=HASH_PROCESSES,
+    # The address of the interface to send Sonos discovery from, if not the default
+    SONOS_INTERFACE=None
+)
+
+def create_app(config=None):
+    app.config.update(config or {})
+    init_db(app.config["DATABASE"])
+    return app
 
 MUSIC_EXT = set(['mp3'])
+EVENT_KEEPALIVE = 15
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+SEARCH_PAGE_SIZE = 25
+MAX_SEARCH_PAGE_SIZE = 100
+
+# Songs accepted by a single /api/playlist/<id>/add_many call
+MAX_BULK_ADD = 500
+
+# Songs are streamed in chunks of this many bytes
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_MIMETYPE = "audio/mpeg"
+
+# Users loaded for sessions, invalidated whenever a user changes
+USER_CACHE_SIZE = 256
+USER_CACHE_TTL = 60
+USER_CACHE = LRUCache(USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1] in MUSIC_EXT
@@ -37,6 +131,36 @@ class APIResponse(Response):
         self.data = json.dumps(data)
         self.mimetype = "application/json"
 
+def encode_cursor(*values):
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+def decode_cursor(cursor, *types):
+    """
+    Returns the values encoded in a cursor, rejecting any cursor which doesn't
+    hold exactly one value of each of `types`.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("utf-8")))
+    except (TypeError, ValueError):
+        raise APIError("Invalid cursor")
+
+    if not isinstance(values, list) or len(values) != len(types):
+        raise APIError("Invalid cursor")
+
+    for value, kind in zip(values, types):
+        if isinstance(value, bool) or not isinstance(value, kind):
+            raise APIError("Invalid cursor")
+    return values
+
+def get_page_size(default=PAGE_SIZE, maximum=MAX_PAGE_SIZE):
+    try:
+        size = int(request.values.get("limit", default))
+    except ValueError:
+        raise APIError("Invalid limit")
+    if size < 1:
+        raise APIError("Invalid limit")
+    return min(size, maximum)
+
 # Auth Decorator
 def authed(f):
     @wraps(f)
@@ -46,19 +170,46 @@ def authed(f):
         return f(*args, **kwargs)
     return wrapped
 
+# Read-only views which never look at the user, so we don't load one for them
+def anonymous(f):
+    f.anonymous = True
+    return f
+
+def load_user(id):
+    """
+    Returns the user for a session, served from USER_CACHE when possible. The
+    cache holds plain field data, every request gets its own User instance.
+    """
+    data = USER_CACHE.get(id)
+    if data is None:
+        try:
+            data = dict(User.get(User.id == id)._data)
+        except User.DoesNotExist:
+            return None
+        USER_CACHE.set(id, data)
+    return User(**data)
+
 @app.before_request
 def before_request():
     g.user = None
-    try:
-        if 'id' in session:
-            g.user = User.get(User.id == session['id'])
 
-    except User.DoesNotExist:
-        g.user = None
+    view = app.view_functions.get(request.endpoint)
+    if request.endpoint == "static" or getattr(view, "anonymous", False):
+        return
+
+    if 'id' in session:
+        g.user = load_user(session['id'])
 
     if "test" in request.headers:
         g.user = User.get(User.id == request.headers.get("test"))
 
+@app.teardown_request
+def teardown_staged_uploads(exc):
+    # Anything an ingest job didn't take over (rejected files, extra fields)
+    for staged in request.staged_uploads:
+        if not staged.claimed:
+            staged.discard()
+
 @app.after_request
 def app_after_request(response):
     if isinstance(response, dict):
@@ -74,6 +225,24 @@ def app_handle_auth_exception(e):
         "msg": e.kwargs.get("msg", "You must be logged in to complete that action")
     }), 401
 
+@app.errorhandler(HasherBusy)
+def app_handle_hasher_busy(e):
+    response = jsonify({
+        "success": False,
+        "msg": "Too many logins right now, try again in a moment"
+    })
+    response.headers["Retry-After"] = "1"
+    return response, 503
+
+@app.errorhandler(PoolExhausted)
+def app_handle_pool_exhausted(e):
+    response = jsonify({
+        "success": False,
+        "msg": "The player is busy right now, try again in a moment"
+    })
+    response.headers["Retry-After"] = "1"
+    return response, 503
+
 @app.errorhandler(APIError)
 def app_handle_api_error(e):
     msg = e.args[0] if len(e.args) else e.kwargs.get("msg", "Generic API Error")
@@ -91,8 +260,70 @@ def route_url_root():
     return render_template('index.html')
 
 @app.route("/api/player/status")
+@anonymous
 def route_player_status():
-    return APIResponse(app.controller.status())
+    status = app.controller.status()
+    etag = str(status["version"])
+
+    if request.values.get("since") == etag or request.if_none_match.contains(etag):
+        return Response(status=304)
+
+    if request.values.get("playlist"):
+        limit = min(int(request.values.get("limit", QUEUE_WINDOW)), QUEUE_WINDOW)
+        try:
+            status["queue"] = app.controller.queue_diff(request.values.get("playlist"), limit)
+        except ValueError:
+            raise APIError("Invalid playlist version")
+
+    response = APIResponse(status)
+    response.set_etag(etag)
+    return response
+
+@app.route("/api/player/queue")
+@anonymous
+def route_player_queue():
+    offset = int(request.values.get("offset", 0))
+    limit = min(int(request.values.get("limit", QUEUE_WINDOW)), QUEUE_WINDOW)
+
+    if offset < 0 or limit < 1:
+        raise APIError("Invalid offset or limit")
+
+    status = app.controller.status()
+    return APIResponse({
+        "offset": offset,
+        "limit": limit,
+        "version": status.get("playlist"),
+        "length": int(status.get("playlistlength", 0)),
+        "queue": app.controller.queue(offset, limit)
+    })
+
+@app.route("/api/player/events")
+@anonymous
+def route_player_events():
+    q = app.controller.subscribe()
+
+    def stream():
+        try:
+            # Always start clients off with the player and the head of the queue
+            yield "data: %s\n\n" % json.dumps({
+                "changed": ["player", "playlist"],
+                "player": app.controller.status(),
+                "playlist": app.controller.queue_diff()
+            })
+
+            while True:
+                try:
+                    event = q.get(timeout=EVENT_KEEPALIVE)
+                except Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield "data: %s\n\n" % json.dumps(event)
+        finally:
+            app.controller.unsubscribe(q)
+
+    return Response(stream(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache"
+    })
 
 PLAYER_ACTIONS = [ "next", "pause", "play", "stop", "shuffle", "random", "clear", "previous", "seek" ]
 
@@ -169,15 +400,28 @@ def route_player_queue_playlist():
     return APIResponse()
 
 @app.route("/api/songs")
+@anonymous
 def route_api_songs():
-    page = int(request.values.get("page", 1))
+    size = get_page_size()
+
+    # Keyset pagination over the (added_date, id) index, every page costs the same
+    songs = Song.select(Song.added_date,
+            *map(lambda i: getattr(Song, i), Song.DICT_FIELDS)
+        ).order_by(Song.added_date, Song.id).limit(size + 1)
+
+    if request.values.get("cursor"):
+        added_date, id = decode_cursor(request.values.get("cursor"), basestring, (int, long))
+        # Written so SQLite can seek into the index on the first column
+        songs = songs.where((Song.added_date >= added_date) &
+            ((Song.added_date > added_date) | (Song.id > id)))
+
+    songs = list(songs)
+    more = len(songs) > size
+    songs = songs[:size]
 
-    songs = Song.select(User.username,
-            *map(lambda i: getattr(Song, i), Song.DICT_FIELDS)).join(
-        User).paginate(page, 100).order_by(Song.added_date)
     return APIResponse({
-        "page": page,
-        "songs": map(lambda i: i.to_dict(), list(songs))
+        "songs": map(lambda i: i.to_dict(), songs),
+        "next": encode_cursor(str(songs[-1].added_date), songs[-1].id) if more else None
     })
 
 @app.route("/api/songs/<id>", methods=["GET", "PUT"])
@@ -200,25 +444,123 @@ def route_api_songs_single(id):
         raise APIError("Invalid Song ID")
       return APIResponse(song.to_dict())
 
+def read_range(f, start, stop):
+    try:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = f.read(min(STREAM_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+@app.route("/api/songs/<id>/stream")
+@anonymous
+def route_api_songs_stream(id):
+    """
+    Serves a song's audio, with Range support so players can seek. With
+    USE_X_SENDFILE the front server sends the file (and handles ranges), else
+    the file goes through wsgi.file_wrapper, which servers implement with
+    sendfile(). Python only copies bytes itself when neither is available.
+    """
+    try:
+        location, checksum = Song.select(Song.location, Song.checksum).where(
+            Song.id == id).tuples().get()
+    except Song.DoesNotExist:
+        raise APIError("Invalid Song ID", 404)
+
+    path = os.path.abspath(location)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        raise APIError("Song file is missing", 404)
+
+    # Tags (e.g. ReplayGain) can be rewritten after upload, the mtime keeps
+    # clients from stitching ranges of two different versions together
+    etag = "%s-%d" % (checksum, stat.st_mtime)
+    if request.if_none_match.contains(etag):
+        return Response(status=304)
+
+    response = Response(mimetype=STREAM_MIMETYPE, direct_passthrough=True)
+    response.set_etag(etag)
+    response.accept_ranges = "bytes"
+    response.cache_control.public = True
+
+    if app.config["USE_X_SENDFILE"]:
+        response.headers["X-Sendfile"] = path
+        return response
+
+    # A stale If-Range means the client gets the whole (new) file instead
+    if_range = request.if_range
+    range_valid = not if_range.date and if_range.etag in (None, etag)
+
+    start, stop = 0, stat.st_size
+    if request.range and range_valid:
+        byte_range = request.range.range_for_length(stat.st_size)
+        if byte_range:
+            start, stop = byte_range
+            response.status_code = 206
+            response.content_range = ContentRange("bytes", start, stop, stat.st_size)
+        elif request.range.units == "bytes" and len(request.range.ranges) == 1:
+            response.status_code = 416
+            response.content_range = ContentRange("bytes", None, None, stat.st_size)
+            return response
+
+    f = open(path, "rb")
+    if "wsgi.file_wrapper" in request.environ:
+        # PEP 3333 servers stop at Content-Length, so a seeked file is enough
+        f.seek(start)
+        response.response = wrap_file(request.environ, f, STREAM_CHUNK_SIZE)
+    else:
+        response.response = read_range(f, start, stop)
+    response.content_length = stop - start
+    return response
+
 @app.route("/api/songs/new", methods=["POST"])
 @authed
 def route_upload():
     f = request.files["file"]
     if f and allowed_file(f.filename):
-        return jsonify({"success": Song.new_from_file(g.user, f)})
+        try:
+            job = app.ingester.submit(g.user, f)
+        except IngestError as e:
+            raise APIError(*e.args)
+        return jsonify({"success": True, "job": job.id}), 202
     raise APIError("No or invalid file specified")
 
+@app.route("/api/songs/jobs/<id>")
+@authed
+def route_upload_job(id):
+    job = app.ingester.get(id)
+    if not job:
+        raise APIError("Invalid Job ID", 404)
+    return APIResponse(job.to_dict())
+
 @app.route("/api/playlists")
+@anonymous
 def route_api_playlists():
-    page = int(request.values.get("page", 1))
+    size = get_page_size()
+
+    playlists = Playlist.select().order_by(Playlist.id).limit(size + 1)
+
+    if request.values.get("cursor"):
+        id, = decode_cursor(request.values.get("cursor"), (int, long))
+        playlists = playlists.where(Playlist.id > id)
+
+    playlists = list(playlists)
+    more = len(playlists) > size
+    playlists = playlists[:size]
 
-    playlists = Playlist.select().paginate(page, 100)
     return APIResponse({
-        "page": page,
-        "playlists": map(lambda i: i.to_dict(), list(playlists))
+        "playlists": map(lambda i: i.to_dict(), playlists),
+        "next": encode_cursor(playlists[-1].id) if more else None
     })
 
 @app.route("/api/playlists/<id>")
+@anonymous
 def route_api_playlists_single(id):
     try:
         pl = Playlist.get(Playlist.id == id)
@@ -240,9 +582,7 @@ def route_api_playlists_create():
 
     return APIResponse({"id": p.id})
 
-@app.route("/api/playlist/<id>/<action>")
-@authed
-def route_api_playlist_modify(id, action):
+def get_modifiable_playlist(id):
     try:
         playlist = Playlist.get(Playlist.id == id)
     except Playlist.DoesNotExist:
@@ -251,37 +591,75 @@ def route_api_playlist_modify(id, action):
     if not playlist.can_user_modify(g.user):
         raise AuthException(msg="Cannot edit private playlist we do not own")
 
+    return playlist
+
+@app.route("/api/playlist/<id>/add_many", methods=["GET", "POST"])
+@authed
+def route_api_playlist_add_many(id):
+    playlist = get_modifiable_playlist(id)
+
+    try:
+        ids = map(int, filter(None, request.values.get("songs", "").split(",")))
+    except ValueError:
+        raise APIError("Invalid Song ID")
+
+    if not ids:
+        raise APIError("Must specify songs to add")
+
+    if len(ids) > MAX_BULK_ADD:
+        raise APIError("Cannot add more than %s songs at once" % MAX_BULK_ADD)
+
+    known = set(i for (i, ) in Song.select(Song.id).where(Song.id << ids).tuples())
+    if len(known) != len(set(ids)):
+        raise APIError("Invalid Song ID")
+
+    added = playlist.add_entries(ids, owner=g.user)
+    return APIResponse({"added": added, "size": playlist.get_songs().count()})
+
+@app.route("/api/playlist/<id>/<action>")
+@authed
+def route_api_playlist_modify(id, action):
+    playlist = get_modifiable_playlist(id)
+
     try:
         song = Song.get(Song.id == request.values.get("song"))
     except Song.DoesNotExist:
         raise APIError("Invalid Song ID")
 
+    pos = int(request.values.get("pos", 0)) or None
+
     # Try adding to the playlist
     if action == "add":
-        playlist.add_song(song)
-        return APIResponse({"pos": playlist.get_songs().count()})
+        if playlist.has_song(song):
+            raise APIError("Song already exists in playlist")
+
+        playlist.add_entry(song, owner=g.user, pos=pos)
+        return APIResponse({"pos": pos or playlist.get_songs().count()})
 
     if action == "remove":
-        playlist.rmv_song(song)
+        playlist.rmv_entry(song)
         return APIResponse({})
 
+    if action == "move":
+        if not pos:
+            raise APIError("Must specify a pos to move the song to")
+
+        try:
+            playlist.move_entry(song, pos)
+        except PlaylistEntry.DoesNotExist:
+            raise APIError("Song is not in this playlist")
+        return APIResponse({"pos": pos})
+
+    raise APIError("Invalid Action")
+
 @app.route("/api/search")
+@anonymous
 def route_api_search():
     if not request.values.get("query"):
         raise APIError("Must specify a query to search")
 
-    songs = FTSSong.search(
-        request.values.get("query")
-    ).order_by(SQL('score')).limit(25)
-
-    playlists = FTSPlaylist.search(
-        request.values.get("query")
-    ).order_by(SQL('score')).limit(25)
-
-    return APIResponse({
-        "songs": map(lambda i: i.song.to_dict(), list(songs)),
-        "playlists": map(lambda i: i.playlist.to_dict(), list(playlists))
-    })
+    return APIResponse(dict(search.search(request.values.get("query"),
+        get_page_size(SEARCH_PAGE_SIZE, MAX_SEARCH_PAGE_SIZE))))
 
 @app.route("/api/users/settings")
 @authed
@@ -293,15 +671,41 @@ def route_users_settings():
         g.user.email = request.values.get("email")
 
     g.user.save()
+    USER_CACHE.delete(g.user.id)
     return APIResponse()
 
 @app.route("/api/users/change_password")
 @authed
 def route_users_change_password():
-    pw = requests.values.get("password")
-    g.user.password = g.user.hash_passowrd(pw)
+    pw = request.values.get("password")
+    if not pw:
+        raise APIError("Invalid Paramaters")
+
+    g.user.password = app.hasher.hash(pw)
+    g.user.save()
+    USER_CACHE.delete(g.user.id)
     return APIResponse()
 
+def authenticate(username, pw):
+    """
+    Checks a login, upgrading the stored hash when it was made with a
+    different work factor than the one we are configured with.
+    """
+    try:
+        u = User.get(User.username == username)
+    except User.DoesNotExist:
+        raise APIError("Incorrect Username")
+
+    if not app.hasher.check(pw, u.password):
+        raise APIError("Incorrect Password")
+
+    if app.hasher.needs_rehash(u.password):
+        u.password = app.hasher.hash(pw)
+        u.save()
+        USER_CACHE.delete(u.id)
+
+    return u
+
 @app.route("/login", methods=["GET", "POST"])
 def route_login():
     if g.user:
@@ -316,15 +720,7 @@ def route_login():
     if not user or not pw:
         raise APIError("Invalid Paramaters")
 
-    try:
-        u = User.get(User.username == user)
-    except User.DoesNotExist:
-        raise APIError("Incorrect Username")
-
-    if not u.check_password(pw):
-        raise APIError("Incorrect Password")
-
-    session["id"] = u.id
+    session["id"] = authenticate(user, pw).id
     return redirect("/", code=302)
 
 @app.route("/api/login", methods=["POST"])
@@ -335,15 +731,7 @@ def route_api_login():
     if not user or not pw:
         raise APIError("Invalid Paramaters")
 
-    try:
-        u = User.get(User.username == user)
-    except User.DoesNotExist:
-        raise APIError("Incorrect Username")
-
-    if not u.check_password(pw):
-        raise APIError("Incorrect Password")
-
-    session["id"] = u.id
+    session["id"] = authenticate(user, pw).id
     return APIResponse()
 
 @app.route("/register", methods=["GET", "POST"])
@@ -365,7 +753,7 @@ def route_register():
     except User.DoesNotExist: pass
 
     u = User(username=params["username"], email=params["email"])
-    u.password = User.hash_password(params["password"])
+    u.password = app.hasher.hash(params["password"])
 
     session["id"] = u.save()
     g.user = u
@@ -387,27 +775,43 @@ def route_register_api():
     except User.DoesNotExist: pass
 
     u = User(username=params["username"], email=params["email"])
-    u.password = User.hash_password(params["password"])
+    u.password = app.hasher.hash(params["password"])
 
     session["id"] = u.save()
     return APIResponse()
 
+def get_speaker():
+    if not request.values.get("ip"):
+        raise APIError("Must specify the ip of a speaker")
+
+    speaker = app.sonos.get(request.values.get("ip"))
+    if not speaker:
+        raise APIError("Unknown speaker", 404)
+    return speaker
+
 @app.route("/api/sonos/list")
+@anonymous
 def route_sonos_list():
-    speakers = soco.discover()
+    players, refreshed = app.sonos.list()
     return APIResponse({
-        "players": {sp.player_name: sp.ip_address for sp in speakers}
+        "players": players,
+        "refreshed": refreshed
     })
 
 @app.route("/api/sonos/start")
 def route_sonos_start():
-    sonos = soco.Soco(request.values.get("ip"))
-    sonos.play_uri("TODO!")
+    try:
+        song = Song.get(Song.id == request.values.get("song"))
+    except Song.DoesNotExist:
+        raise APIError("Invalid Song ID")
+
+    sonos = get_speaker()
+    sonos.play_uri(url_for("route_api_songs_stream", id=song.id, _external=True))
     return APIResponse()
 
 @app.route("/api/sonos/stop")
 def route_sonos_stop():
-    sonos = soco.Soco(request.values.get("ip"))
+    sonos = get_speaker()
     sonos.stop()
     return APIResponse()
 
@@ -416,7 +820,10 @@ def run():
         print "Invalid MUSIC_DIR path `%s`!" % MUSIC_DIR
         sys.exit(1)
 
-    app.run("0.0.0.0", port=3000, debug=True)
+    application = create_app()
+    # Scan for speakers now, rather than on the first Sonos request
+    application.sonos.start()
+    application.run("0.0.0.0", port=3000, debug=True, threaded=True)
 
 if __name__ == "__main__":
     run()
@@ -0,0 +1,74 @@
+"""
+Bulk song insert throughput with the search index kept in sync.
+
+  - legacy: per-save sync from Python, a SELECT and a write on the FTS table
+    after every save (how BModel.save used to work)
+  - triggers: Song.save() with the index maintained by SQLite triggers
+  - bulk: insert_many in a single transaction, again via triggers
+
+    python bench/fts_insert.py [songs]
+"""
+import os, sys, time, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from peewee import Model
+from db import db, init_db, User, Song, FTSSong
+
+def reset(triggers):
+    for table in [User, Song, FTSSong]:
+        table.drop_table(True)
+        table.create_table(True)
+
+    if triggers:
+        FTSSong.create_triggers()
+
+    return User.create(username="bench", password="")
+
+def song(user, i):
+    return dict(owner=user, title="title %s" % i, artist="artist %s" % i,
+        album="album %s" % i, checksum=str(i), location="song%s.mp3" % i)
+
+def legacy(user, count):
+    for i in range(count):
+        s = Song(**song(user, i))
+        Model.save(s)
+
+        try:
+            fts = FTSSong.get(FTSSong.song == s.id)
+        except FTSSong.DoesNotExist:
+            fts = FTSSong(song=s.id)
+        fts.title, fts.artist, fts.album = s.title, s.artist, s.album
+        fts.save()
+
+def triggers(user, count):
+    for i in range(count):
+        Song.create(**song(user, i))
+
+def bulk(user, count):
+    with db.transaction():
+        for start in range(0, count, 100):
+            Song.insert_many([song(user, i) for i in range(start, min(start + 100, count))]).execute()
+
+def main(count=2000):
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    init_db(path)
+
+    try:
+        for name, fn, use_triggers in [
+                ("legacy", legacy, False),
+                ("triggers", triggers, True),
+                ("bulk", bulk, True)]:
+            user = reset(use_triggers)
+            start = time.time()
+            fn(user, count)
+            took = time.time() - start
+
+            assert FTSSong.select().count() == count
+            print "%-10s %8.0f songs/s" % (name, count / took)
+    finally:
+        os.remove(path)
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
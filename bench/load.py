@@ -0,0 +1,99 @@
+"""
+Load tests the hot read endpoints, comparing the threaded development server
+with the gevent server from serve.py. Both are started from this checkout, so
+MPD has to be reachable and the database populated.
+
+    python bench/load.py [clients] [seconds per endpoint]
+"""
+import os, sys, time, socket, httplib, threading, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENDPOINTS = [
+    "/api/player/status",
+    "/api/songs",
+    "/api/search?query=a",
+]
+
+DEV_SERVER = """
+import app
+app.create_app().run("127.0.0.1", port=%(port)s, threaded=True)
+"""
+
+SERVERS = [
+    ("dev", lambda port: [sys.executable, "-c", DEV_SERVER % {"port": port}]),
+    ("gevent", lambda port: [sys.executable, "serve.py", "--host", "127.0.0.1", "--port", str(port)]),
+]
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def wait_for(port, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise Exception("Server on port %s never came up" % port)
+
+def hammer(port, url, deadline, counts):
+    conn = httplib.HTTPConnection("127.0.0.1", port, timeout=10)
+    ok = errors = 0
+    while time.time() < deadline:
+        try:
+            conn.request("GET", url)
+            response = conn.getresponse()
+            response.read()
+            if response.status == 200:
+                ok += 1
+            else:
+                errors += 1
+        except (socket.error, httplib.HTTPException):
+            errors += 1
+            conn.close()
+            conn = httplib.HTTPConnection("127.0.0.1", port, timeout=10)
+    conn.close()
+    counts.append((ok, errors))
+
+def measure(port, url, clients, seconds):
+    counts = []
+    deadline = time.time() + seconds
+    threads = [threading.Thread(target=hammer, args=(port, url, deadline, counts))
+        for _ in range(clients)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return sum(i[0] for i in counts) / float(seconds), sum(i[1] for i in counts)
+
+def main(clients=32, seconds=5):
+    results = {}
+    for name, command in SERVERS:
+        port = free_port()
+        server = subprocess.Popen(command(port), cwd=ROOT)
+        try:
+            wait_for(port)
+            for url in ENDPOINTS:
+                results[name, url] = measure(port, url, clients, seconds)
+        finally:
+            server.terminate()
+            server.wait()
+
+    print "%-24s %14s %14s" % ("%s clients" % clients, "dev req/s", "gevent req/s")
+    for url in ENDPOINTS:
+        row = []
+        for name, _ in SERVERS:
+            rate, errors = results[name, url]
+            row.append("%.0f" % rate + (" (%s err)" % errors if errors else ""))
+        print "%-24s %14s %14s" % (url, row[0], row[1])
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,77 @@
+"""
+Measures login throughput with many clients logging in at once, and how
+slow a cheap read-only request gets while that is happening. Logins turned
+away with a 503 are counted separately.
+
+    python bench/login.py [clients] [logins per client] [bcrypt rounds]
+"""
+import os, sys, time, tempfile, threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+from db import User, Playlist
+from passwords import hash_password
+
+def percentile(times, p):
+    times = sorted(times)
+    return times[min(len(times) - 1, int(len(times) * p))] if times else 0
+
+def login(client, results, logins):
+    for _ in range(logins):
+        start = time.time()
+        r = client.post("/api/login", data={"user": "bench", "password": "hunter2"})
+        results.append((r.status_code, time.time() - start))
+
+def probe(client, latencies, done):
+    while not done.is_set():
+        start = time.time()
+        assert client.get("/api/playlists").status_code == 200
+        latencies.append(time.time() - start)
+        time.sleep(0.01)
+
+def main(clients=16, logins=5, rounds=10):
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+
+    try:
+        juicebox = app.create_app({"DATABASE": path, "BCRYPT_ROUNDS": rounds})
+        User.create_table(True)
+        Playlist.create_table(True)
+        User.create(username="bench", password=hash_password("hunter2", rounds))
+
+        # Spawn the hashing processes before the clock starts
+        juicebox.hasher.start()
+
+        results, latencies = [], []
+        done = threading.Event()
+        prober = threading.Thread(target=probe, args=(juicebox.test_client(), latencies, done))
+        prober.start()
+
+        threads = [threading.Thread(target=login, args=(juicebox.test_client(), results, logins))
+            for _ in range(clients)]
+
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        took = time.time() - start
+
+        done.set()
+        prober.join()
+    finally:
+        os.remove(path)
+
+    ok = [t for code, t in results if code == 200]
+    busy = len([code for code, t in results if code == 503])
+
+    print "logins: %s ok, %s busy, %.1f/s over %.2fs (%s clients, %s rounds)" % (
+        len(ok), busy, len(ok) / took, took, clients, rounds)
+    print "login latency: p50 %.1fms, p95 %.1fms" % (
+        percentile(ok, 0.5) * 1000, percentile(ok, 0.95) * 1000)
+    print "read latency during logins: p50 %.1fms, p95 %.1fms" % (
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000)
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
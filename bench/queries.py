@@ -0,0 +1,77 @@
+"""
+Checks that the list and search endpoints run a constant number of SQL
+statements, no matter how many rows they return.
+
+    python bench/queries.py
+"""
+import os, sys, json, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+from db import db, count_queries, User, Song, FTSSong, Playlist, FTSPlaylist, PlaylistEntry
+
+# URL, and the lists in its response which must not come back empty
+ENDPOINTS = [
+    ("/api/songs", ["songs"]),
+    ("/api/songs/1", []),
+    ("/api/playlists", ["playlists"]),
+    ("/api/playlists/1", []),
+    ("/api/search?query=song", ["songs", "playlists"]),
+]
+
+def populate(size):
+    for table in [User, Song, Playlist, PlaylistEntry, FTSSong, FTSPlaylist]:
+        table.drop_table(True)
+        table.create_table(True)
+
+    # The search index is only filled by these
+    for table in [FTSSong, FTSPlaylist]:
+        table.create_triggers()
+
+    with db.transaction():
+        for i in range(size):
+            user = User.create(username="user%s" % i, password="")
+            Song.create(owner=user, title="song %s" % i, artist="artist %s" % i,
+                checksum=str(i), location="song%s.mp3" % i)
+            Playlist.create(owner=user, title="song playlist %s" % i)
+
+def measure(client, size):
+    populate(size)
+
+    counts = {}
+    for url, keys in ENDPOINTS:
+        with count_queries() as counter:
+            response = client.get(url)
+        assert response.status_code == 200, url
+
+        # A constant count means nothing if the endpoint found nothing
+        data = json.loads(response.data)
+        for key in keys:
+            assert data[key], "%s returned no %s for %s rows" % (url, key, size)
+
+        counts[url] = counter.count
+    return counts
+
+def main():
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+
+    try:
+        client = app.create_app({"DATABASE": path}).test_client()
+        small, large = measure(client, 5), measure(client, 50)
+    finally:
+        os.remove(path)
+
+    failed = False
+    for url, _ in ENDPOINTS:
+        ok = small[url] == large[url]
+        failed = failed or not ok
+        print "%-28s %3s queries for 5 rows, %3s for 50 rows %s" % (
+            url, small[url], large[url], "" if ok else "<- grows with rows!")
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Runs SonosRegistry discovery against fake Sonos speakers on the loopback
+interface, and checks that listing and looking up speakers is served from
+the cache. The fake answers SSDP M-SEARCH requests on 239.255.255.250:1900
+and the ZoneGroupTopology UPnP call discovery makes on port 1400, so both
+ports must be free.
+
+    python bench/sonos.py
+"""
+import os, sys, time, socket, threading
+from xml.sax.saxutils import escape
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sonos import SonosRegistry
+
+SSDP_GROUP = "239.255.255.250"
+SSDP_PORT = 1900
+INTERFACE = "127.0.0.1"
+
+# Every loopback address reaches the fake, so each speaker gets its own
+SPEAKERS = {"Kitchen": "127.0.0.2", "Office": "127.0.0.3"}
+
+SSDP_RESPONSE = "\r\n".join([
+    "HTTP/1.1 200 OK",
+    "CACHE-CONTROL: max-age = 1800",
+    "EXT:",
+    "LOCATION: http://%s:1400/xml/device_description.xml" % INTERFACE,
+    "SERVER: Linux UPnP/1.0 Sonos/26.1-76230 (ZPS3)",
+    "ST: urn:schemas-upnp-org:device:ZonePlayer:1",
+    "", ""])
+
+MEMBER = ('<ZoneGroupMember UUID="RINCON_%(ip)s" ZoneName="%(name)s" '
+    'Location="http://%(ip)s:1400/xml/device_description.xml"/>')
+
+ZONE_GROUP_STATE = "<ZoneGroups>%s</ZoneGroups>" % "".join(
+    '<ZoneGroup Coordinator="RINCON_%s" ID="RINCON_%s:1">%s</ZoneGroup>' % (
+        ip, ip, MEMBER % {"ip": ip, "name": name}) for name, ip in SPEAKERS.items())
+
+SOAP_RESPONSE = (
+    '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" '
+    's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>'
+    '<u:GetZoneGroupStateResponse xmlns:u="urn:schemas-upnp-org:service:ZoneGroupTopology:1">'
+    '<ZoneGroupState>%s</ZoneGroupState>'
+    '</u:GetZoneGroupStateResponse></s:Body></s:Envelope>') % escape(ZONE_GROUP_STATE)
+
+class FakeSpeaker(BaseHTTPRequestHandler):
+    requests = 0
+
+    def do_POST(self):
+        FakeSpeaker.requests += 1
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", 'text/xml; charset="utf-8"')
+        self.send_header("Content-Length", str(len(SOAP_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(SOAP_RESPONSE)
+
+    def log_message(self, *args):
+        pass
+
+def ssdp_responder(searches):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("", SSDP_PORT))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+        socket.inet_aton(SSDP_GROUP) + socket.inet_aton(INTERFACE))
+
+    def run():
+        while True:
+            data, addr = sock.recvfrom(1024)
+            if data.startswith("M-SEARCH"):
+                searches.append(addr)
+                sock.sendto(SSDP_RESPONSE, addr)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+def start_fake():
+    searches = []
+    ssdp_responder(searches)
+
+    server = HTTPServer(("", 1400), FakeSpeaker)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return searches
+
+def main():
+    searches = start_fake()
+
+    # Lookups right after startup wait for the first scan instead of failing
+    fresh = SonosRegistry(timeout=2, interface_addr=INTERFACE)
+    assert fresh.get(SPEAKERS["Kitchen"]), "speaker turned away before the first scan finished"
+    registry = SonosRegistry(timeout=2, interface_addr=INTERFACE)
+
+    # The first list starts the background scan and returns straight away
+    start = time.time()
+    players, refreshed = registry.list()
+    assert not players and refreshed is None
+
+    while registry.list()[1] is None:
+        assert time.time() - start < 10, "discovery never finished"
+        time.sleep(0.01)
+    scan = time.time() - start
+
+    players, refreshed = registry.list()
+    assert searches, "discovery never reached the fake SSDP responder"
+    assert players == SPEAKERS, "discovered %r, expected %r" % (players, SPEAKERS)
+
+    # Served from the cache from here on, the fake must not be asked again
+    requests = FakeSpeaker.requests
+    start = time.time()
+    for _ in range(1000):
+        registry.list()
+        for ip in SPEAKERS.values():
+            assert registry.get(ip).ip_address == ip
+    cached = (time.time() - start) / 1000
+
+    assert registry.get("10.255.255.1") is None, "cached a speaker discovery never found"
+    assert FakeSpeaker.requests == requests, "cached lookups went to the network"
+
+    print "discovered %s speakers in %.1fms, cached list + get took %.3fms" % (
+        len(players), scan * 1000, cached * 1000)
+
+if __name__ == "__main__":
+    main()
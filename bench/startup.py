@@ -0,0 +1,39 @@
+"""
+Measures how long it takes to import and create the app, and fails if that
+goes over budget. Creating the app must never connect to MPD, Gracenote or
+the database.
+
+    python bench/startup.py [runs]
+"""
+import os, sys, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Seconds a cold import + create_app may take
+BUDGET = 0.5
+
+SNIPPET = """
+import time
+start = time.time()
+import app
+app.create_app()
+took = time.time() - start
+assert app.app._controller is None, "create_app connected to MPD"
+print took
+"""
+
+def measure():
+    return float(subprocess.check_output([sys.executable, "-c", SNIPPET], cwd=ROOT))
+
+def main(runs=5):
+    times = sorted(measure() for _ in range(runs))
+    median = times[len(times) / 2]
+    print "startup: median %.1fms, min %.1fms, max %.1fms over %s runs" % (
+        median * 1000, times[0] * 1000, times[-1] * 1000, runs)
+
+    if median > BUDGET:
+        print "startup is over the %.1fms budget!" % (BUDGET * 1000)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,43 @@
+import time, threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    """
+    A small thread-safe LRU cache, optionally expiring entries after `ttl`
+    seconds.
+    """
+    def __init__(self, size=128, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, stored = self.entries.pop(key)
+            except KeyError:
+                return default
+
+            if self.ttl and stored < time.time() - self.ttl:
+                return default
+
+            # Re-insert to mark as most recently used
+            self.entries[key] = (value, stored)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.time())
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
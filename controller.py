@@ -1,81 +1,412 @@
-import logging
+import logging, threading, time, random
+from array import array
+from collections import deque
+from Queue import Queue, Full
 
-from mpd import MPDClient
+from cache import LRUCache
 from db import Song
+from mpd import CommandError
+from pool import MPDPool, CONNECTION_ERRORS
 
 log = logging.getLogger(__name__)
 
+# The MPD subsystems we forward to event subscribers
+EVENT_SUBSYSTEMS = ["player", "playlist", "mixer", "options"]
+
+# How many queue entries clients are sent at once
+QUEUE_WINDOW = 100
+
+# How many songs are sent to MPD in a single command list
+MPD_BATCH_SIZE = 500
+
+# How many MPD connections request threads may hold at once
+MPD_POOL_SIZE = 4
+
+# How many upcoming songs random mode keeps queued in MPD
+RANDOM_WINDOW = 10
+
+# Seconds the idle listener waits before retrying after an unexpected error
+LISTENER_RETRY_DELAY = 1
+
+# How many resolved now-playing songs are remembered, keyed by MPD songid
+SONG_CACHE_SIZE = 64
+
 class Controller(object):
     class Mode:
         NONE = 0
         QUEUE = 1
         RANDOM = 2
 
-    def __init__(self, host="/run/mpd/socket"):
-        self.cli = MPDClient()
-        self.cli.timeout = 10
-        self.cli.idletimeout = None
-        self.cli.connect(host, 0)
-        log.info("Controller connected to MPD server version %s" % self.cli.mpd_version)
+    def __init__(self, host="/run/mpd/socket", batch_size=MPD_BATCH_SIZE, pool_size=MPD_POOL_SIZE):
+        self.batch_size = batch_size
+        self.progress = None
+        self.pool = MPDPool(host, size=pool_size)
+
+        self.subscribers = []
+        self.subscribers_lock = threading.Lock()
 
+        # The last known player state, rebuilt by the idle listener
+        self.version = 0
+        self.snapshot = None
+        self.snapshot_lock = threading.Lock()
+        self.song_cache = LRUCache(SONG_CACHE_SIZE)
+        with self.pool.connection() as cli:
+            log.info("Controller connected to MPD server version %s" % cli.mpd_version)
+            # Loudness is measured on ingest and stored in the files' tags
+            cli.replay_gain_mode("track")
+            self.refresh(cli)
+
+        # Random mode state, see `top_up`
+        self.random_ids = array("l")
+        self.random_recent = deque(maxlen=RANDOM_WINDOW * 5)
+        self.random_lock = threading.Lock()
         self.mode = Controller.Mode.NONE
+
+        self.listener = threading.Thread(target=self.listen)
+        self.listener.daemon = True
+        self.listener.start()
+
         self.switch_mode(Controller.Mode.RANDOM)
 
+    def subscribe(self):
+        """
+        Returns a queue which will receive an event dict every time one of the
+        EVENT_SUBSYSTEMS changes on the MPD server.
+        """
+        q = Queue(maxsize=32)
+        with self.subscribers_lock:
+            self.subscribers.append(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self.subscribers_lock:
+            if q in self.subscribers:
+                self.subscribers.remove(q)
+
+    def publish(self, event):
+        with self.subscribers_lock:
+            subscribers = list(self.subscribers)
+
+        for q in subscribers:
+            try:
+                q.put_nowait(event)
+            except Full:
+                # Slow consumers just miss events, they'll catch up on the next
+                log.warning("Dropping player event for slow subscriber")
+
+    def listen(self):
+        """
+        Runs forever on a dedicated MPD connection, waiting on `idle` and
+        publishing the changed subsystems to all subscribers.
+        """
+        cli = None
+        while True:
+            try:
+                if not cli:
+                    cli = self.pool.connect(retries=-1)
+                    # We may have missed changes while disconnected
+                    self.refresh(cli)
+
+                changed = cli.idle(*EVENT_SUBSYSTEMS)
+                self.refresh(cli)
+                self.publish(self.build_event(changed))
+
+                if self.mode == Controller.Mode.RANDOM and "playlist" in changed:
+                    self.top_up(cli)
+            except CONNECTION_ERRORS:
+                log.exception("Lost MPD idle connection, reconnecting")
+                cli = None
+            except Exception:
+                # This is the only listener, it must never die. The connection
+                # may be mid command list, so start over on a fresh one.
+                log.exception("Failed handling MPD change, reconnecting")
+                if cli:
+                    try:
+                        cli.disconnect()
+                    except CONNECTION_ERRORS:
+                        pass
+                cli = None
+                time.sleep(LISTENER_RETRY_DELAY)
+
+    def refresh(self, cli):
+        """
+        Rebuilds the cached player snapshot. The current song is only fetched
+        again when MPD reports a new songid, and the queue is never fetched in
+        full, only the window entries which changed since the last playlist
+        version.
+        """
+        with self.snapshot_lock:
+            status = cli.status()
+            previous = self.snapshot
+
+            if previous and previous["status"].get("playlist") == status.get("playlist"):
+                previous_playlist, changes = previous["previous_playlist"], previous["changes"]
+            elif previous:
+                previous_playlist = previous["status"].get("playlist")
+                changes = self.window_changes(cli, previous_playlist)
+            else:
+                previous_playlist, changes = None, []
+
+            if previous and previous["status"].get("songid") == status.get("songid"):
+                song = previous["song"]
+            else:
+                song = self.song_info(cli)
+
+            self.version += 1
+            self.snapshot = {
+                "version": self.version,
+                "taken": time.time(),
+                "status": status,
+                "song": song,
+                "previous_playlist": previous_playlist,
+                "changes": changes
+            }
+
+    def window_changes(self, cli, since, limit=QUEUE_WINDOW):
+        """
+        Returns the entries within the first `limit` positions which changed
+        since the playlist version `since`. Consume mode shifts every position
+        on each track change, so only positions and ids are asked for across
+        the whole queue, and full entries only for the changed window.
+        """
+        positions = set(int(i["cpos"]) for i in cli.plchangesposid(since))
+        positions = sorted(i for i in positions if i < limit)
+        if not positions:
+            return []
+
+        entries = cli.playlistinfo("%d:%d" % (positions[0], positions[-1] + 1))
+        return [i for i in entries if int(i["pos"]) in positions]
+
+    def song_info(self, cli):
+        """
+        Returns MPD's current song merged with our own record of it. Songs are
+        matched on their location and memoized per MPD songid, so the database
+        is only queried when a new track starts.
+        """
+        current_song = cli.currentsong()
+        if 'file' not in current_song:
+            return current_song
+
+        key = (current_song.get('id'), current_song['file'])
+        record = self.song_cache.get(key)
+
+        if record is None:
+            try:
+                location = Song.location_from_mpd(current_song['file'])
+                record = Song.get(Song.location == location).to_dict()
+            except Song.DoesNotExist:
+                record = {}
+            self.song_cache.set(key, record)
+
+        info = dict(current_song)
+        info.update(record)
+        return info
+
+    def build_event(self, changed):
+        snapshot = self.snapshot
+        event = {"changed": changed, "version": snapshot["version"]}
+
+        if "player" in changed or "options" in changed:
+            event["player"] = self.player_status(snapshot)
+
+        if "playlist" in changed:
+            event["playlist"] = self.queue_diff(snapshot["previous_playlist"])
+
+        if "mixer" in changed:
+            event["mixer"] = {"volume": snapshot["status"].get("volume")}
+
+        if self.progress:
+            event["progress"] = dict(self.progress)
+
+        return event
+
+    def player_status(self, snapshot):
+        status = dict(snapshot["status"].items() + snapshot["song"].items())
+        status["version"] = snapshot["version"]
+
+        if self.progress:
+            status["progress"] = dict(self.progress)
+
+        # MPD only tells us about state changes, so extrapolate the play time
+        if status.get("state") == "play" and "elapsed" in status:
+            elapsed = float(status["elapsed"]) + (time.time() - snapshot["taken"])
+            status["elapsed"] = "%.3f" % min(elapsed, float(status.get("time", elapsed)))
+
+        return status
+
     def add_song(self, song):
-        self.cli.add(song.as_mpd())
+        self.pool.execute("add", song.as_mpd())
 
     def add_playlist(self, playlist):
-        map(self.cli.add, playlist.as_mpd())
+        self.add_many(playlist.as_mpd(), playlist.get_songs().count())
+
+    def add_many(self, paths, total=None):
+        """
+        Queues every path from the `paths` iterable, sending them to MPD in
+        command lists of `batch_size` adds instead of one round-trip each.
+        """
+        self.progress = {"done": 0, "total": total}
+        batch = []
+
+        try:
+            with self.pool.connection() as cli:
+                for path in paths:
+                    batch.append(path)
+                    if len(batch) >= self.batch_size:
+                        self.add_batch(cli, batch)
+                        batch = []
+
+                if batch:
+                    self.add_batch(cli, batch)
+        finally:
+            log.info("Queued %s songs" % self.progress["done"])
+            self.progress = None
+
+    def add_batch(self, cli, batch):
+        cli.command_list_ok_begin()
+        for path in batch:
+            cli.add(path)
+        cli.command_list_end()
+
+        self.progress["done"] += len(batch)
+        log.debug("Queued %s/%s songs" % (self.progress["done"], self.progress["total"]))
 
     def switch_mode(self, mode):
-        self.mode = Controller.Mode.RANDOM
-
-        if mode == Controller.Mode.RANDOM:
-            self.cli.consume(0)
-            self.cli.random(1)
-            self.cli.repeat(1)
-            self.cli.single(0)
-            self.cli.clear()
-
-            # Load up a ton of random songs
-            playlist = Song.as_mpd_playlist(Song.select())
-            map(self.cli.add, playlist)
-
-        if mode == Controller.Mode.QUEUE:
-            self.cli.consume(1)
-            self.cli.random(0)
-            self.cli.repeat(0)
-            self.cli.single(0)
-            self.cli.clear()
+        self.mode = mode
+
+        with self.pool.connection() as cli:
+            if mode == Controller.Mode.RANDOM:
+                cli.consume(1)
+                cli.random(0)
+                cli.repeat(0)
+                cli.single(0)
+                cli.clear()
+
+                # Only the ids are kept around, songs are looked up as they're picked
+                with self.random_lock:
+                    self.random_ids = array("l", (i for (i, ) in
+                        Song.select(Song.id).order_by(Song.id).tuples().iterator()))
+                    self.random_recent.clear()
+
+                self.top_up(cli)
+                cli.play()
+
+            if mode == Controller.Mode.QUEUE:
+                cli.consume(1)
+                cli.random(0)
+                cli.repeat(0)
+                cli.single(0)
+                cli.clear()
+
+    def top_up(self, cli):
+        """
+        Keeps RANDOM_WINDOW randomly picked songs queued while in random mode.
+        Played songs are consumed by MPD, so this is called every time the
+        playlist changes.
+        """
+        with self.random_lock:
+            if self.mode != Controller.Mode.RANDOM:
+                return
+
+            missing = RANDOM_WINDOW - int(cli.status().get("playlistlength", 0))
+            if missing <= 0:
+                return
+
+            # Pick up anything uploaded since we built the id array
+            newest = self.random_ids[-1] if self.random_ids else 0
+            self.random_ids.extend(i for (i, ) in Song.select(Song.id).where(
+                Song.id > newest).order_by(Song.id).tuples().iterator())
+
+            paths = filter(None, (self.pick_random() for _ in range(missing)))
+            if not paths:
+                return
+
+            # Added one by one, a single unplayable file (e.g. deleted from
+            # disk) would otherwise fail the whole command list
+            for path in paths:
+                try:
+                    cli.add(path)
+                except CommandError:
+                    log.warning("Skipping unplayable random pick %s" % path)
+
+    def pick_random(self):
+        if not self.random_ids:
+            return None
+
+        # Try not to repeat anything we've recently played, unless the library
+        # is too small for that to be possible.
+        for _ in range(5):
+            song_id = random.choice(self.random_ids)
+            if song_id not in self.random_recent:
+                break
+
+        self.random_recent.append(song_id)
+        row = Song.select(Song.location).where(Song.id == song_id).tuples().first()
+        return Song.location_as_mpd(row[0]) if row else None
 
     def status(self):
-      current_song = self.cli.currentsong()
-      status = self.cli.status().items() + current_song.items()
-      if 'title' in current_song:
-          try:
-              s = Song.get(Song.title == current_song['title'])
-              status += s.to_dict().items()
-          except Song.DoesNotExist: pass
-
-      status = dict(status)
-      status['playlist'] = self.cli.playlistinfo()
-      return status
+      """
+      Returns the cached player status, this never touches MPD or the database.
+      """
+      return self.player_status(self.snapshot)
+
+    def queue(self, offset=0, limit=QUEUE_WINDOW):
+      return self.pool.execute("playlistinfo", "%d:%d" % (offset, offset + limit))
+
+    def queue_diff(self, since=None, limit=QUEUE_WINDOW):
+      """
+      Returns the queue entries within the first `limit` positions which
+      changed since the playlist version `since`. Without a version, or with
+      one MPD never handed out (its versions restart with MPD), the first
+      `limit` entries are returned instead with `from` set to None. Raises
+      ValueError if `since` isn't a number.
+      """
+      snapshot = self.snapshot
+      version = snapshot["status"].get("playlist")
+      diff = {
+          "from": since,
+          "version": version,
+          "length": int(snapshot["status"].get("playlistlength", 0))
+      }
+
+      if since is not None:
+          since = int(since)
+          if since < 0 or since > int(version):
+              since = None
+
+      if since is None:
+          diff["from"] = None
+          diff["changes"] = self.queue(0, limit)
+          return diff
+
+      # Clients that kept up are all one version behind, which the listener
+      # already fetched. Anything older is rare and not worth caching.
+      if since == int(version):
+          changes = []
+      elif snapshot["previous_playlist"] is not None and since == int(snapshot["previous_playlist"]):
+          changes = snapshot["changes"]
+      else:
+          with self.pool.connection() as cli:
+              changes = self.window_changes(cli, since, limit)
+
+      diff["changes"] = filter(lambda i: int(i["pos"]) < limit, changes)
+      return diff
 
     def play(self):
-      self.cli.play()
+      self.pool.execute("play")
 
     def pause(self):
-      self.cli.pause()
+      self.pool.execute("pause")
 
     def stop(self):
-      self.cli.stop()
+      self.pool.execute("stop")
 
     def previous(self):
-      self.cli.previous()
+      self.pool.execute("previous")
 
     def next(self):
-      self.cli.next()
+      self.pool.execute("next")
 
 
     def seek(self, ts):
-      self.cli.seekcur(ts);
+      self.pool.execute("seekcur", ts)
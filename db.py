@@ -1,69 +1,179 @@
 import os, sys
-import bcrypt, eyed3, uuid, pygn
+import eyed3
 
 from datetime import datetime
 
 from peewee import *
-from playhouse.sqlite_ext import SqliteExtDatabase, FTSModel
+from playhouse.sqlite_ext import SqliteExtDatabase, FTSModel, _parse_match_info
+from playhouse.migrate import SqliteMigrator, migrate
 from gravatar import Gravatar
 
-db = SqliteExtDatabase("juicebox.db", threadlocals=True)
+import passwords
+
+DB_PATH = "juicebox.db"
+
+# Peewee only opens the file on the first query, init_db can point it elsewhere
+db = SqliteExtDatabase(DB_PATH, threadlocals=True)
+
+def init_db(path=DB_PATH):
+    db.init(path)
+
+@db.func("weighted_rank", -1)
+def weighted_rank(raw_match_info, *weights):
+    """
+    Like peewee's `rank`, but every column's hits are multiplied by the weight
+    given for it. Expects matchinfo in the default 'pcx' format.
+    """
+    match_info = _parse_match_info(raw_match_info)
+    score = 0.0
+    p, c = match_info[:2]
+    for phrase_num in range(p):
+        phrase_info_idx = 2 + (phrase_num * c * 3)
+        for col_num in range(c):
+            col_idx = phrase_info_idx + (col_num * 3)
+            x1, x2 = match_info[col_idx:col_idx + 2]
+            if x1 > 0:
+                score += weights[col_num] * float(x1) / x2
+    return score
+
+class count_queries(object):
+    """
+    Counts the SQL statements executed inside the block, used to make sure
+    endpoints run a constant number of queries.
+
+        with count_queries() as counter:
+            ...
+        print counter.count
+    """
+    def __enter__(self):
+        self.count = 0
+        self.execute_sql = db.execute_sql
+
+        def execute_sql(*args, **kwargs):
+            self.count += 1
+            return self.execute_sql(*args, **kwargs)
+
+        db.execute_sql = execute_sql
+        return self
+
+    def __exit__(self, *args):
+        del db.execute_sql
 
 MUSIC_DIR = "data/music"
-MD5SUM = "md5 -q" if sys.platform == "darwin" else "md5sum"
+# Any algorithm supported by hashlib.new
+CHECKSUM_ALGORITHM = "md5"
 GN_CLI = "3392512-77AC0BD72360CA0653409F31B97412CF"
-GN_USR = pygn.register(GN_CLI)
 
 class BModel(Model):
     SEARCHABLE = False
 
+    # Bumped on every save of a searchable model, lets search.py drop results
+    search_version = 0
+
     class Meta:
         database = db
 
-    def get_search_model(self):
-        return None
-
     def save(self, *args, **kwargs):
         id = Model.save(self, *args, **kwargs)
 
+        # The search index itself is kept in sync by triggers, see SModel
         if self.SEARCHABLE:
-            search_model = self.get_search_model()
-            if bool(self._get_pk_value()):
-                search_model.update_from(self)
-            else:
-                search_model.create_from(self)
+            BModel.search_version += 1
         return id
 
+# Marks the matched words in snippets, see search.highlight
+SNIPPET_START = "\x02"
+SNIPPET_END = "\x03"
+
 class SModel(FTSModel):
+    # Search weight of every column, in column order. Unlisted columns are 0.
+    WEIGHTS = {}
+
     class Meta:
         database = db
 
     @classmethod
-    def update_fields(cls, instA, instB):
-        relation_name = instA.__class__.__name__.lower()
-        setattr(instB, relation_name, instA.id)
+    def create_table(cls, fail_silently=False, **options):
+        # Prefix indexes keep search-as-you-type queries fast
+        options.setdefault("prefix", "'2,3'")
+        # The source ID is only stored, otherwise queries like "1*" match it
+        options.setdefault("notindexed", cls.get_source()[0].db_column)
+        return super(SModel, cls).create_table(fail_silently, **options)
 
-        for field in cls._meta.fields.keys():
-            if field == "id" or field == relation_name: continue
-            setattr(instB, field, getattr(instA, field))
+    @classmethod
+    def indexes_source_id(cls):
+        """
+        Returns whether this table was created before its source ID column
+        was made `notindexed`, and so has to be recreated.
+        """
+        sql, = db.execute_sql("SELECT sql FROM sqlite_master WHERE name = ?",
+            (cls._meta.db_table, )).fetchone()
+        return "notindexed" not in sql
 
     @classmethod
-    def create_from(cls, inst):
-        self = cls()
-        cls.update_fields(inst, self)
-        self.save()
-        return self
+    def weighted_rank(cls):
+        weights = [cls.WEIGHTS.get(field.name, 0) for field in cls._meta.get_fields()]
+        return fn.weighted_rank(fn.matchinfo(cls._as_entity(), "pcx"), *weights)
 
     @classmethod
-    def update_from(cls, inst):
-        parent_name = inst.__class__.__name__.lower()
-        try:
-            self = cls.get(getattr(cls, parent_name) == inst)
-        except cls.DoesNotExist:
-            return cls.create_from(inst)
-        cls.update_fields(inst, self)
-        self.save()
-        return self
+    def snippet(cls):
+        # Control characters rather than tags, the text isn't escaped yet
+        return fn.snippet(cls._as_entity(), SNIPPET_START, SNIPPET_END, "...", -1, 12)
+
+    @classmethod
+    def get_source(cls):
+        """
+        Returns the foreign key to the model this table indexes, and the
+        indexed columns.
+        """
+        fields = cls._meta.get_fields()
+        fk = [i for i in fields if isinstance(i, ForeignKeyField)][0]
+        return fk, [i for i in fields if i is not fk and i.name != "id"]
+
+    @classmethod
+    def create_triggers(cls):
+        """
+        Creates triggers which keep this table in sync with the model it
+        indexes. Rows are stored under the docid of their source row, so
+        updates and deletes are a single lookup by docid.
+        """
+        fk, columns = cls.get_source()
+        source = fk.rel_model._meta.db_table
+        table = cls._meta.db_table
+
+        names = ", ".join(["docid", fk.db_column] + [i.db_column for i in columns])
+        values = ", ".join(["new.id", "new.id"] + ["coalesce(new.%s, '')" % i.db_column for i in columns])
+        updates = ", ".join("%s = coalesce(new.%s, '')" % (i.db_column, i.db_column) for i in columns)
+        watched = ", ".join(i.db_column for i in columns)
+
+        # Recreated rather than skipped, so older definitions get replaced
+        for action in ["insert", "update", "delete"]:
+            db.execute_sql("DROP TRIGGER IF EXISTS %s_search_%s" % (source, action))
+
+        # Updates to other columns (e.g. ReplayGain values) leave the index alone
+        for sql in [
+                "CREATE TRIGGER %s_search_insert AFTER INSERT ON %s BEGIN "
+                "INSERT INTO %s (%s) VALUES (%s); END" % (source, source, table, names, values),
+                "CREATE TRIGGER %s_search_update AFTER UPDATE OF %s ON %s BEGIN "
+                "UPDATE %s SET %s WHERE docid = new.id; END" % (source, watched, source, table, updates),
+                "CREATE TRIGGER %s_search_delete AFTER DELETE ON %s BEGIN "
+                "DELETE FROM %s WHERE docid = old.id; END" % (source, source, table)]:
+            db.execute_sql(sql)
+
+    @classmethod
+    def repopulate(cls):
+        """
+        Repopulates the whole table from the model it indexes.
+        """
+        fk, columns = cls.get_source()
+        table = cls._meta.db_table
+
+        db.execute_sql("DELETE FROM %s" % table)
+        db.execute_sql("INSERT INTO %s (%s) SELECT %s FROM %s" % (
+            table,
+            ", ".join(["docid", fk.db_column] + [i.db_column for i in columns]),
+            ", ".join(["id", "id"] + ["coalesce(%s, '')" % i.db_column for i in columns]),
+            fk.rel_model._meta.db_table))
 
 class User(BModel):
     username = CharField()
@@ -76,16 +186,23 @@ class User(BModel):
         g = Gravatar(self.email or username+"@getbraintree.com")
         return "http://unicornify.appspot.com/avatar/%s?s=%s" % size
 
+    # These hash inline, request handlers should go through app.hasher
     @staticmethod
     def hash_password(pw):
-        return bcrypt.hashpw(pw.encode('utf-8'), bcrypt.gensalt())
+        return passwords.hash_password(pw)
 
     def check_password(self, pw):
-        return bcrypt.hashpw(pw.encode('utf-8'), self.password.encode('utf-8')) == self.password.encode('utf-8')
+        return passwords.check_password(pw, self.password)
 
 class Song(BModel):
     SEARCHABLE = True
-    DICT_FIELDS = ["id", "owner", "title", "artist", "album", "checksum"]
+    DICT_FIELDS = ["id", "owner", "title", "artist", "album", "cover", "checksum"]
+
+    class Meta:
+        indexes = (
+            (("artist", "title"), True),
+            (("added_date", "id"), False),
+        )
 
     class MediaType:
         SONG = 1
@@ -96,18 +213,45 @@ class Song(BModel):
     album = CharField(null=True)
     cover = CharField(null=True)
     mediatype = IntegerField(default=MediaType.SONG)
-    checksum = CharField(null=False)
-    location = CharField()
+    checksum = CharField(null=False, unique=True)
+    location = CharField(index=True)
     added_date = DateTimeField(default=datetime.utcnow)
 
+    # ReplayGain track gain (dB) and peak, applied by MPD at playback
+    gain = FloatField(null=True)
+    peak = FloatField(null=True)
+
     def as_mpd(self):
         """
         Returns the location of this song as a mpd-queueable file-path
         """
-        return "file://" + os.path.join(os.getcwd(), self.location)
+        return Song.location_as_mpd(self.location)
 
-    def get_search_model(self):
-        return FTSSong
+    @staticmethod
+    def location_as_mpd(location):
+        return "file://" + os.path.join(os.getcwd(), location)
+
+    @staticmethod
+    def normalize_location(path):
+        """
+        Every location is stored in this form: relative to the working
+        directory for files under it (like uploads), absolute otherwise.
+        """
+        path = os.path.abspath(path)
+        cwd = os.getcwd()
+        if path.startswith(cwd + os.sep):
+            return os.path.relpath(path, cwd)
+        return path
+
+    @staticmethod
+    def location_from_mpd(path):
+        """
+        The inverse of `location_as_mpd`, turns the `file` MPD reports for a
+        song back into the location we stored.
+        """
+        if path.startswith("file://"):
+            path = path[len("file://"):]
+        return Song.normalize_location(path)
 
     def create_song_path(self):
         DIR = os.path.join(MUSIC_DIR, self.owner.username)
@@ -128,63 +272,18 @@ class Song(BModel):
 
     @classmethod
     def as_mpd_playlist(cls, qset):
-        return map(lambda i: i.as_mpd(), list(qset))
-
-    @classmethod
-    def new_from_file(cls, user, fobj):
-        temp_name_base = str(uuid.uuid4())
-        temp_name = os.path.join(MUSIC_DIR, temp_name_base + ".mp3")
-        fobj.save(temp_name)
-
-        # First lets grab the metadata
-        cur = os.getcwd()
-        os.chdir(MUSIC_DIR)
-
-        meta = eyed3.load(os.path.basename(temp_name))
-        os.chdir(cur)
-
-        # Grab checksum
-        checksum = os.popen("%s %s" % (MD5SUM, temp_name)).read().split(" ", 1)[0]
-
-        # Normalize Audio
-        new_temp_name = os.path.join(MUSIC_DIR, temp_name_base + "_normal.mp3")
-        os.popen("sox --norm %s %s" % (temp_name, new_temp_name))
-        temp_name = new_temp_name
-
-        # We need some basic stuff
-        if not meta.tag.artist or not meta.tag.title:
-            raise Exception("Not enough metadata")
-
-        count = cls.select(cls.id).where(
-            ((cls.artist == meta.tag.artist) & (cls.title == meta.tag.title)) |
-            (cls.checksum == checksum)
-        ).count()
-
-        # Already exists
-        if count:
-            return -1
-
-        # Attempt to get album art
-        pygn_meta = pygn.search(clientID=GN_CLI, userID=GN_USR,
-            artist=meta.tag.artist,
-            album=meta.tag.album,
-            track=meta.tag.title)
-
-        song = cls()
-        song.owner = user
-        song.title = meta.tag.title
-        song.artist = meta.tag.artist
-        song.album = meta.tag.album
-        song.cover = pygn_meta.get("album_art_url")
-        song.location = song.create_song_path()
-        song.checksum = checksum
-        os.rename(temp_name, song.location)
-        return song.save()
+        """
+        Lazily yields the mpd-queueable paths for a query, only selecting the
+        location column and never building Song instances.
+        """
+        for (location, ) in qset.select(cls.location).tuples().iterator():
+            yield cls.location_as_mpd(location)
 
     def to_dict(self):
         return {
             "id": self.id,
-            "owner": self.owner.id,
+            # Read the raw foreign key, `self.owner` would query for the user
+            "owner": self._data.get("owner"),
             "title": self.title,
             "artist": self.artist,
             "album": self.album,
@@ -196,81 +295,346 @@ class Song(BModel):
         return eyed3.load(self.location)
 
 class FTSSong(SModel):
+    WEIGHTS = {"title": 3.0, "artist": 2.0, "album": 1.0}
+
     song = ForeignKeyField(Song)
     title = TextField()
     artist = TextField()
     album = TextField()
 
 class Playlist(BModel):
+    SEARCHABLE = True
+
     owner = ForeignKeyField(User)
     title = CharField()
     public = BooleanField(default=False)
 
     def can_user_modify(self, user):
-        if public:
+        if self.public:
             return True
         elif self.owner == user:
             return True
         else:
             return False
 
+    def last_position(self):
+        return PlaylistEntry.select(fn.Max(PlaylistEntry.pos)).where(
+            PlaylistEntry.playlist == self).scalar() or 0
+
+    def position_for(self, index, exclude=None):
+        """
+        Returns a `pos` value which sorts an entry at the 1-based `index` of
+        the playlist. Positions are spaced POS_GAP apart, so this normally
+        fits between the neighbours without touching them. Only when a gap
+        has been used up do the entries around it get renumbered.
+        """
+        entries = self.get_songs()
+        if exclude:
+            entries = entries.where(PlaylistEntry.id != exclude.id)
+
+        if index > 1:
+            neighbours = list(entries.offset(index - 2).limit(2))
+            if not neighbours:
+                return self.last_position() + PlaylistEntry.POS_GAP
+            before, after = (neighbours + [None])[:2]
+        else:
+            before, after = None, entries.limit(1).first()
+
+        if not after:
+            return (before.pos if before else 0) + PlaylistEntry.POS_GAP
+
+        # Positions are only used for sorting, so the head can go negative
+        # and is never used up.
+        if not before:
+            return after.pos - PlaylistEntry.POS_GAP
+
+        if after.pos - before.pos < 2:
+            self.respace(index, exclude)
+            return self.position_for(index, exclude)
+        return (before.pos + after.pos) // 2
+
+    def respace(self, index, exclude=None):
+        """
+        Spreads out the entries around the 1-based `index`, so a new position
+        fits there again. The window starts with a few entries on either side
+        and doubles until the positions around it leave enough room, which is
+        asked of small windows more strictly than large ones. Repeated inserts
+        at one spot therefore renumber a handful of entries most of the time,
+        and only rarely a larger part of the playlist.
+        """
+        entries = self.get_songs()
+        if exclude:
+            entries = entries.where(PlaylistEntry.id != exclude.id)
+
+        level = 1
+        while True:
+            half = 2 ** level
+            start = max(0, index - 1 - half)
+
+            # The window, plus the entries bounding it on either side
+            rows = list(entries.select(PlaylistEntry.id, PlaylistEntry.pos).offset(
+                max(0, start - 1)).limit(2 * half + 2).tuples())
+            lower = rows.pop(0) if start > 0 else None
+            upper = rows.pop() if len(rows) > 2 * half else None
+            window = [id for id, _ in rows]
+
+            # An open end means room to spare, the head may go negative
+            if not upper:
+                base = lower[1] if lower else rows[0][1] - PlaylistEntry.POS_GAP
+                positions = [base + (i + 1) * PlaylistEntry.POS_GAP for i in range(len(window))]
+                break
+            if not lower:
+                positions = [upper[1] - (len(window) - i) * PlaylistEntry.POS_GAP for i in range(len(window))]
+                break
+
+            gap = (upper[1] - lower[1]) // (len(window) + 1)
+            if gap >= max(2, PlaylistEntry.POS_GAP >> level):
+                positions = [lower[1] + (i + 1) * gap for i in range(len(window))]
+                break
+            level += 1
+
+        with db.transaction():
+            # Park the window (and the entry being moved) below every current
+            # and new position first, so renumbering never collides with the
+            # unique (playlist, pos) index.
+            low, high = self.position_range()
+            parked = window + ([exclude.id] if exclude else [])
+            PlaylistEntry.update(pos=PlaylistEntry.pos - (high - low + 1) - len(window) * PlaylistEntry.POS_GAP).where(
+                PlaylistEntry.id << parked).execute()
+
+            for id, pos in zip(window, positions):
+                PlaylistEntry.update(pos=pos).where(PlaylistEntry.id == id).execute()
+
+    def position_range(self):
+        return PlaylistEntry.select(fn.Min(PlaylistEntry.pos), fn.Max(PlaylistEntry.pos)).where(
+            PlaylistEntry.playlist == self).tuples().get()
+
+    def rebalance(self):
+        """
+        Renumbers the whole playlist POS_GAP apart.
+        """
+        entries = list(self.get_songs().select(PlaylistEntry.id).tuples())
+
+        with db.transaction():
+            # Park everything below zero first (positions may already be
+            # negative), so renumbering never collides with the unique
+            # (playlist, pos) index.
+            low, high = self.position_range()
+            PlaylistEntry.update(pos=PlaylistEntry.pos - (high or 0) - 1).where(
+                PlaylistEntry.playlist == self).execute()
+
+            for index, (id, ) in enumerate(entries):
+                PlaylistEntry.update(pos=(index + 1) * PlaylistEntry.POS_GAP).where(
+                    PlaylistEntry.id == id).execute()
+
     def rmv_entry(self, song):
-        entry = PlaylistEntry.get(
+        # Positions are only used for sorting, so the gap can just stay
+        PlaylistEntry.delete().where(
             (PlaylistEntry.song == song) &
-            (PlaylistEntry.playlist == self))
-
-        # If we are no the last entry, we need to resort the playlist
-        if entry.pos < self.get_songs.count():
-            for plentry in list(self.get_songs())[entry.pos:]:
-                plentry.pos -= 1
-                plentry.save()
+            (PlaylistEntry.playlist == self)).execute()
 
-        entry.delete_instance()
+    def has_song(self, song):
+        return PlaylistEntry.select().where(
+            (PlaylistEntry.playlist == self) &
+            (PlaylistEntry.song == song)).exists()
 
     def add_entry(self, song, owner=None, pos=None):
-        playlist = list(self.get_songs())
-
-        if song.id in map(lambda i: i.song.id, playlist):
+        if self.has_song(song):
             raise Exception("Song already exists in playlist")
 
-        # If a position is given, we may have to shuffle things around
         if pos:
-            # Move current shit out of the way
-            for plentry in playlist[pos-1:]:
-                plentry.pos += 1
-                plentry.save()
+            position = self.position_for(pos)
+        else:
+            position = self.last_position() + PlaylistEntry.POS_GAP
 
-        return PlaylistEntry.create(playlist=self, song=song, owner=owner, pos=len(playlist) + 1)
+        return PlaylistEntry.create(playlist=self, song=song, owner=owner, pos=position)
+
+    def add_entries(self, song_ids, owner=None):
+        """
+        Appends many songs to the end of the playlist in one transaction,
+        skipping songs which are already in it. Returns the number of songs
+        added.
+        """
+        existing = set(i for (i, ) in PlaylistEntry.select(PlaylistEntry.song).where(
+            (PlaylistEntry.playlist == self) &
+            (PlaylistEntry.song << song_ids)).tuples())
+
+        new_ids = []
+        for song_id in song_ids:
+            if song_id not in existing:
+                existing.add(song_id)
+                new_ids.append(song_id)
+
+        if not new_ids:
+            return 0
+
+        with db.transaction():
+            start = self.last_position()
+            rows = [{
+                "playlist": self.id,
+                "song": song_id,
+                "owner": owner,
+                "pos": start + (index + 1) * PlaylistEntry.POS_GAP,
+            } for index, song_id in enumerate(new_ids)]
+
+            for offset in range(0, len(rows), PlaylistEntry.INSERT_SIZE):
+                PlaylistEntry.insert_many(rows[offset:offset + PlaylistEntry.INSERT_SIZE]).execute()
+
+        return len(new_ids)
+
+    def move_entry(self, song, pos):
+        entry = PlaylistEntry.get(
+            (PlaylistEntry.song == song) &
+            (PlaylistEntry.playlist == self))
+        entry.pos = self.position_for(pos, exclude=entry)
+        entry.save()
+        return entry
 
     def as_mpd(self):
-        return map(lambda i: i.as_mpd(), self.get_songs())
+        return Song.as_mpd_playlist(PlaylistEntry.select().join(Song).where(
+            PlaylistEntry.playlist == self).order_by(PlaylistEntry.pos))
 
     def get_songs(self):
-        return PlaylistEntry.join(Song).select(PlaylistEntry.playlist == self).order_by(PlaylistEntry.pos)
+        return PlaylistEntry.select().where(PlaylistEntry.playlist == self).order_by(PlaylistEntry.pos)
 
     def to_dict(self):
         return {
             "id": self.id,
-            "owner": self.owner.id,
+            "owner": self._data.get("owner"),
             "title": self.title,
             "public": self.public
         }
 
 class FTSPlaylist(SModel):
+    WEIGHTS = {"title": 1.0}
+
     playlist = ForeignKeyField(Playlist)
     title = TextField()
 
 class PlaylistEntry(BModel):
+    # Spacing between the positions of neighbouring entries
+    POS_GAP = 1024
+
+    # Rows per INSERT, keeps us well under SQLite's bound parameter limit
+    INSERT_SIZE = 100
+
+    class Meta:
+        indexes = (
+            (("playlist", "pos"), True),
+            (("playlist", "song"), True),
+        )
+
     playlist = ForeignKeyField(Playlist)
     song = ForeignKeyField(Song)
     owner = ForeignKeyField(User, null=True)
     pos = IntegerField()
 
+class Setting(BModel):
+    key = CharField(unique=True)
+    value = TextField(null=True)
+
+    @classmethod
+    def get_value(cls, key, default=None):
+        try:
+            return cls.get(cls.key == key).value
+        except cls.DoesNotExist:
+            return default
+
+    @classmethod
+    def set_value(cls, key, value):
+        if not cls.update(value=value).where(cls.key == key).execute():
+            cls.create(key=key, value=value)
+
+class GracenoteCache(BModel):
+    key = CharField(unique=True)
+    data = TextField(null=True)
+    fetched = DateTimeField(default=datetime.utcnow)
+
+def rebuild_search_index():
+    with db.transaction():
+        for table in [FTSSong, FTSPlaylist]:
+            table.create_triggers()
+            table.repopulate()
+    BModel.search_version += 1
+
+def missing_indexes(model):
+    """
+    Returns the (fields, unique) pairs of the indexes `model` declares which
+    don't exist in the database yet.
+    """
+    table = model._meta.db_table
+    existing = set(row[1] for row in db.execute_sql("PRAGMA index_list(%s)" % table))
+
+    declared = [([i], i.unique) for i in model._fields_to_index()]
+    declared += [([model._meta.fields[i] for i in fields], unique)
+        for fields, unique in model._meta.indexes]
+
+    return [(fields, unique) for fields, unique in declared
+        if "%s_%s" % (table, "_".join(i.db_column for i in fields)) not in existing]
+
+def migrate_db():
+    """
+    Brings an existing database up to date with the models, creating missing
+    tables, columns and indexes without touching existing data. Safe to run
+    any number of times.
+    """
+    models = [User, Song, Playlist, PlaylistEntry, Setting, GracenoteCache]
+    for model in models + [FTSSong, FTSPlaylist]:
+        model.create_table(True)
+
+    # Repopulated by the rebuild below
+    for model in [FTSSong, FTSPlaylist]:
+        if model.indexes_source_id():
+            model.drop_table()
+            model.create_table()
+
+    migrator = SqliteMigrator(db)
+    for model in models:
+        table = model._meta.db_table
+        columns = set(row[1] for row in db.execute_sql("PRAGMA table_info(%s)" % table))
+        migrate(*[migrator.add_column(table, field.db_column, field)
+            for field in model._meta.get_fields() if field.db_column not in columns])
+
+    # Older imports stored paths exactly as they were passed in
+    with db.transaction():
+        for id, location in list(Song.select(Song.id, Song.location).tuples()):
+            if Song.normalize_location(location) != location:
+                Song.update(location=Song.normalize_location(location)).where(Song.id == id).execute()
+
+    if missing_indexes(PlaylistEntry):
+        # Older versions allowed duplicate entries and positions
+        with db.transaction():
+            PlaylistEntry.delete().where(~(PlaylistEntry.id << PlaylistEntry.select(
+                fn.Min(PlaylistEntry.id)).group_by(PlaylistEntry.playlist, PlaylistEntry.song))).execute()
+            for playlist in Playlist.select():
+                playlist.rebalance()
+
+    for model in models:
+        for fields, unique in missing_indexes(model):
+            try:
+                db.create_index(model, fields, unique)
+            except IntegrityError:
+                print "Could not create unique index on %s (%s), remove the duplicate rows and run this again" % (
+                    model._meta.db_table, ", ".join(i.name for i in fields))
+
+    rebuild_search_index()
+
 # TODO: stats, likes
 
 if __name__ == "__main__":
-    for table in [User, Song, Playlist, PlaylistEntry, FTSSong, FTSPlaylist]:
+    if sys.argv[1:] == ["rebuild_search_index"]:
+        rebuild_search_index()
+        sys.exit(0)
+
+    if sys.argv[1:] == ["migrate"]:
+        migrate_db()
+        sys.exit(0)
+
+    for table in [User, Song, Playlist, PlaylistEntry, FTSSong, FTSPlaylist, Setting, GracenoteCache]:
         table.drop_table(True)
         table.create_table(True)
 
+    for table in [FTSSong, FTSPlaylist]:
+        table.create_triggers()
+
     User(username="1", password=User.hash_password("1")).save()
@@ -0,0 +1,71 @@
+import json, logging, threading
+import pygn
+
+from datetime import datetime, timedelta
+from peewee import IntegrityError
+
+from db import GN_CLI, Setting, GracenoteCache
+
+log = logging.getLogger(__name__)
+
+# How long lookups are trusted before we ask Gracenote again
+CACHE_TTL = timedelta(days=30)
+MISS_TTL = timedelta(days=1)
+
+_user = None
+_user_lock = threading.Lock()
+
+def get_user():
+    """
+    Returns our Gracenote user ID, registering only if we've never done so
+    before. The ID is persisted, so restarts don't cost a network call.
+    """
+    global _user
+
+    with _user_lock:
+        if not _user:
+            _user = Setting.get_value("gracenote_user")
+
+        if not _user:
+            _user = pygn.register(GN_CLI)
+            Setting.set_value("gracenote_user", _user)
+
+    return _user
+
+def cache_key(artist, album, track):
+    return u"\x1f".join(u" ".join((i or u"").lower().split()) for i in (artist, album, track))
+
+def search(artist, album, track):
+    """
+    Cached version of `pygn.search`, returns the metadata dict for a track or
+    None if Gracenote had nothing for it. Misses are cached as well, but for
+    a shorter time.
+    """
+    key = cache_key(artist, album, track)
+
+    try:
+        entry = GracenoteCache.get(GracenoteCache.key == key)
+        ttl = CACHE_TTL if entry.data else MISS_TTL
+        if entry.fetched > datetime.utcnow() - ttl:
+            return json.loads(entry.data) if entry.data else None
+    except GracenoteCache.DoesNotExist:
+        entry = GracenoteCache(key=key)
+
+    log.debug("Gracenote cache miss for %r" % key)
+    meta = pygn.search(clientID=GN_CLI, userID=get_user(),
+        artist=artist or "",
+        album=album or "",
+        track=track or "")
+
+    # pygn hands back an empty metadata dict when nothing matched
+    if meta and not meta.get("album_gnid"):
+        meta = None
+
+    entry.data = json.dumps(meta) if meta else None
+    entry.fetched = datetime.utcnow()
+    try:
+        entry.save()
+    except IntegrityError:
+        # Another upload of the same album beat us to it
+        pass
+    return meta
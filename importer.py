@@ -0,0 +1,137 @@
+"""
+Bulk imports an existing music directory into the library.
+
+    python importer.py --user <username> [directory]
+
+Files are scanned (ID3 tag + checksum) in parallel across all cores, then
+inserted in large transactions. Files whose location is already in the
+database are skipped, so an interrupted import can simply be run again.
+"""
+import os, sys, logging, argparse
+
+from multiprocessing import Pool, cpu_count
+
+from db import db, MUSIC_DIR, BModel, User, Song
+from ingest import STAGING_DIR, read_tag, checksum_file
+
+log = logging.getLogger(__name__)
+
+MUSIC_EXT = set(['mp3'])
+
+# Rows per transaction, and per INSERT statement (SQLite caps query params)
+TRANSACTION_SIZE = 1000
+INSERT_SIZE = 100
+
+def find_files(root):
+    # Never import half-uploaded songs, however the root is spelled
+    staging = os.path.realpath(STAGING_DIR)
+
+    for path, dirs, files in os.walk(root):
+        dirs[:] = [i for i in dirs if os.path.realpath(os.path.join(path, i)) != staging]
+
+        for name in files:
+            if name.rsplit(".", 1)[-1].lower() in MUSIC_EXT:
+                yield os.path.join(path, name)
+
+def scan_file(path):
+    """
+    Runs in the process pool, returns the row for a file or None if the file
+    could not be read or lacks the metadata we need.
+    """
+    try:
+        artist, title, album = read_tag(path)
+        if not artist or not title:
+            return None
+        return {
+            "location": path,
+            "checksum": checksum_file(path),
+            "artist": artist,
+            "title": title,
+            "album": album
+        }
+    except Exception:
+        return None
+
+class Importer(object):
+    def __init__(self, user, processes=None):
+        self.user = user
+        self.processes = processes or cpu_count()
+        self.stats = {"imported": 0, "duplicate": 0, "invalid": 0, "skipped": 0}
+
+        # Everything we know about, to dedupe without a query per file
+        self.locations = set(i for (i, ) in Song.select(Song.location).tuples().iterator())
+        self.checksums = set(i for (i, ) in Song.select(Song.checksum).tuples().iterator())
+        self.names = set(Song.select(Song.artist, Song.title).tuples().iterator())
+
+    def is_duplicate(self, row):
+        return row["checksum"] in self.checksums or (row["artist"], row["title"]) in self.names
+
+    def run(self, root):
+        paths = []
+        for path in find_files(root):
+            # Stored the same way as uploads, so MPD's paths map back to it
+            path = Song.normalize_location(path)
+            if path in self.locations:
+                self.stats["skipped"] += 1
+            else:
+                paths.append(path)
+
+        log.info("Scanning %s new files (%s already imported)" % (len(paths), self.stats["skipped"]))
+
+        pool = Pool(self.processes)
+        batch = []
+        try:
+            for row in pool.imap_unordered(scan_file, paths, chunksize=16):
+                if not row:
+                    self.stats["invalid"] += 1
+                    continue
+
+                if self.is_duplicate(row):
+                    self.stats["duplicate"] += 1
+                    continue
+
+                self.checksums.add(row["checksum"])
+                self.names.add((row["artist"], row["title"]))
+                row["owner"] = self.user
+                batch.append(row)
+
+                if len(batch) >= TRANSACTION_SIZE:
+                    self.insert(batch)
+                    batch = []
+
+            if batch:
+                self.insert(batch)
+        finally:
+            pool.terminate()
+
+        return self.stats
+
+    def insert(self, rows):
+        # The search index is filled in by triggers
+        with db.transaction():
+            for start in range(0, len(rows), INSERT_SIZE):
+                Song.insert_many(rows[start:start + INSERT_SIZE]).execute()
+
+        BModel.search_version += 1
+        self.stats["imported"] += len(rows)
+        log.info("Imported %(imported)s songs (%(duplicate)s duplicates, %(invalid)s invalid)" % self.stats)
+
+def main():
+    parser = argparse.ArgumentParser(description="Import a music directory into the library")
+    parser.add_argument("directory", nargs="?", default=MUSIC_DIR)
+    parser.add_argument("--user", required=True, help="username to own the imported songs")
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    try:
+        user = User.get(User.username == args.user)
+    except User.DoesNotExist:
+        print "Unknown user `%s`!" % args.user
+        sys.exit(1)
+
+    print Importer(user, args.processes).run(args.directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,325 @@
+import os, re, sys, time, uuid, hashlib, logging, threading, subprocess
+import eyed3, eyed3.id3, gracenote
+
+from multiprocessing import cpu_count
+from multiprocessing.pool import Pool, ThreadPool
+
+from peewee import IntegrityError
+
+from db import db, MUSIC_DIR, CHECKSUM_ALGORITHM, Song
+
+log = logging.getLogger(__name__)
+
+STAGING_DIR = os.path.join(MUSIC_DIR, ".staging")
+
+# How long finished jobs are kept around for clients to poll
+JOB_TTL = 60 * 60
+
+# Size of the reads used when streaming uploads into the staging area
+CHUNK_SIZE = 64 * 1024
+
+# ReplayGain 2.0 targets -18 LUFS
+REFERENCE_LOUDNESS = -18.0
+
+EBUR128_RE = re.compile(r"I:\s+(-?[\d.]+) LUFS.*?Peak:\s+(-?[\d.]+|-inf) dBFS", re.S)
+
+class IngestError(Exception): pass
+
+def read_tag(path):
+    """
+    Reads only the ID3 header of a file, without touching the audio frames.
+    """
+    tag = eyed3.id3.Tag()
+    if not tag.parse(path):
+        return None, None, None
+    return tag.artist, tag.title, tag.album
+
+# Stages which run inside the process pool must be module level functions
+def analyze_loudness(path):
+    """
+    Measures the EBU R128 integrated loudness and true peak of a file, and
+    returns its ReplayGain track gain (dB) and peak (linear), or Nones if the
+    file could not be analyzed.
+    """
+    try:
+        output = subprocess.Popen(
+            ["ffmpeg", "-nostats", "-i", path, "-filter_complex", "ebur128=peak=true", "-f", "null", "-"],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0]
+    except OSError:
+        return None, None
+
+    # The summary is printed last, after the per-frame measurements
+    match = EBUR128_RE.search(output[output.rfind("Summary:"):])
+    if not match:
+        return None, None
+
+    loudness, peak = match.groups()
+    peak = 0.0 if peak == "-inf" else 10 ** (float(peak) / 20)
+    return REFERENCE_LOUDNESS - float(loudness), peak
+
+def write_replaygain(path, gain, peak):
+    """
+    Stores the gain in the file's ID3 tag, where MPD picks it up at playback.
+    Only the tag is rewritten, the audio itself is untouched.
+    """
+    tag = eyed3.id3.Tag()
+    if not tag.parse(path):
+        tag = eyed3.id3.Tag()
+    tag.user_text_frames.set(u"%.2f dB" % gain, u"REPLAYGAIN_TRACK_GAIN")
+    tag.user_text_frames.set(u"%.6f" % peak, u"REPLAYGAIN_TRACK_PEAK")
+    tag.save(path)
+
+def analyze_file(path):
+    gain, peak = analyze_loudness(path)
+    if gain is not None:
+        write_replaygain(path, gain, peak)
+    return gain, peak
+
+def checksum_file(path):
+    checksum = hashlib.new(CHECKSUM_ALGORITHM)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+class StagedUpload(object):
+    """
+    A new file in STAGING_DIR which hashes everything written to it. The app
+    has werkzeug parse uploads straight into one of these, so an upload is
+    written to disk once and never read back just to be hashed.
+    """
+    def __init__(self):
+        if not os.path.exists(STAGING_DIR):
+            os.makedirs(STAGING_DIR)
+
+        self.path = os.path.join(STAGING_DIR, str(uuid.uuid4()) + ".mp3")
+        self.file = open(self.path, "w+b")
+        self.checksum = hashlib.new(CHECKSUM_ALGORITHM)
+        self.claimed = False
+
+    @classmethod
+    def from_stream(cls, stream):
+        staged = cls()
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), ""):
+            staged.write(chunk)
+        return staged
+
+    def write(self, data):
+        self.checksum.update(data)
+        self.file.write(data)
+
+    def __getattr__(self, name):
+        # Werkzeug reads, seeks and closes us like any other file
+        return getattr(self.file, name)
+
+    def claim(self):
+        """
+        Hands the file over to an ingest job, returning its checksum.
+        """
+        self.claimed = True
+        self.file.close()
+        return self.checksum.hexdigest()
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class Job(object):
+    class Stage:
+        QUEUED = "queued"
+        ANALYZE = "analyze"
+        LOOKUP = "lookup"
+        SAVE = "save"
+        DONE = "done"
+        FAILED = "failed"
+
+    STAGES = [Stage.QUEUED, Stage.ANALYZE, Stage.LOOKUP, Stage.SAVE, Stage.DONE]
+
+    def __init__(self, user, path, checksum, artist, title, album):
+        self.id = uuid.uuid4().hex
+        self.user = user
+        self.path = path
+        self.checksum = checksum
+        self.artist = artist
+        self.title = title
+        self.album = album
+        self.stage = Job.Stage.QUEUED
+        self.error = None
+        self.song = None
+        self.finished = None
+
+    def set_stage(self, stage):
+        log.debug("Ingest job %s entering stage %s" % (self.id, stage))
+        self.stage = stage
+
+    def progress(self):
+        if self.stage == Job.Stage.FAILED:
+            return 1.0
+        return Job.STAGES.index(self.stage) / float(len(Job.STAGES) - 1)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "stage": self.stage,
+            "progress": self.progress(),
+            "error": self.error,
+            "song": self.song
+        }
+
+class Ingester(object):
+    """
+    Accepts uploads into a staging area and runs them through the ingest
+    stages in the background. CPU bound stages (loudness analysis) run in a
+    process pool, while each job is driven by a thread from a thread pool
+    which also performs the network bound Gracenote lookup.
+    """
+    # serve.py swaps this for a gevent friendly pool
+    pool_class = Pool
+
+    def __init__(self, processes=None, threads=4):
+        self.processes = processes or cpu_count()
+        self.threads = threads
+        self.process_pool = None
+        self.thread_pool = None
+
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if not self.process_pool:
+                self.process_pool = self.pool_class(self.processes)
+                self.thread_pool = ThreadPool(self.threads)
+
+    def submit(self, user, fobj):
+        self.start()
+
+        staged = fobj.stream
+        if not isinstance(staged, StagedUpload):
+            staged = StagedUpload.from_stream(staged)
+
+        try:
+            job = self.precheck(user, staged.path, staged.claim())
+        except:
+            staged.discard()
+            raise
+
+        with self.lock:
+            self.prune()
+            self.jobs[job.id] = job
+
+        self.thread_pool.apply_async(self.run, (job, ))
+        return job
+
+    def precheck(self, user, path, checksum):
+        """
+        Cheap checks which reject an upload before any expensive stage runs.
+        """
+        artist, title, album = read_tag(path)
+
+        # We need some basic stuff
+        if not artist or not title:
+            raise IngestError("Not enough metadata")
+
+        if Song.select(Song.id).where(
+                ((Song.artist == artist) & (Song.title == title)) |
+                (Song.checksum == checksum)).exists():
+            raise IngestError("Song already exists", 409)
+
+        return Job(user, path, checksum, artist, title, album)
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def prune(self):
+        cutoff = time.time() - JOB_TTL
+        for job_id, job in self.jobs.items():
+            if job.finished and job.finished < cutoff:
+                del self.jobs[job_id]
+
+    def run(self, job):
+        try:
+            job.set_stage(Job.Stage.ANALYZE)
+            gain, peak = self.process_pool.apply(analyze_file, (job.path, ))
+
+            # Attempt to get album art
+            job.set_stage(Job.Stage.LOOKUP)
+            pygn_meta = gracenote.search(job.artist, job.album, job.title)
+
+            job.set_stage(Job.Stage.SAVE)
+            song = Song()
+            song.owner = job.user
+            song.title = job.title
+            song.artist = job.artist
+            song.album = job.album
+            song.cover = pygn_meta.get("album_art_url") if pygn_meta else None
+            song.location = Song.normalize_location(song.create_song_path())
+            song.checksum = job.checksum
+            song.gain = gain
+            song.peak = peak
+
+            # The row goes in first, the unique indexes decide which of two
+            # concurrent uploads owns the path. Only the winner moves its file
+            # there, and the row is rolled back if that fails.
+            try:
+                with db.transaction():
+                    song.save()
+                    os.rename(job.path, song.location)
+            except IntegrityError:
+                # Somebody else uploaded the same song while we were working
+                raise IngestError("Song already exists")
+
+            job.song = song.id
+            job.set_stage(Job.Stage.DONE)
+        except IngestError as e:
+            job.error = e.args[0]
+            job.set_stage(Job.Stage.FAILED)
+        except Exception:
+            log.exception("Ingest job %s failed" % job.id)
+            job.error = "Failed to ingest song"
+            job.set_stage(Job.Stage.FAILED)
+        finally:
+            job.finished = time.time()
+            # Only ever the staged upload, it's gone once moved into place
+            if os.path.exists(job.path):
+                os.remove(job.path)
+
+def analyze_library(processes=None):
+    """
+    Analyzes every song which has no gain yet, e.g. songs from before gain
+    was measured or from a bulk import. Results are saved in batches.
+    """
+    songs = Song.select(Song.id, Song.location).where(Song.gain >> None).tuples()
+    ids, paths = zip(*songs) if songs.count() else ([], [])
+
+    pool = Pool(processes or cpu_count())
+    try:
+        results = []
+        for song_id, (gain, peak) in zip(ids, pool.imap(analyze_file, paths, chunksize=4)):
+            if gain is not None:
+                results.append((song_id, gain, peak))
+
+            if len(results) >= 100:
+                save_gains(results)
+                results = []
+
+        save_gains(results)
+    finally:
+        pool.terminate()
+
+def save_gains(results):
+    with db.transaction():
+        for song_id, gain, peak in results:
+            Song.update(gain=gain, peak=peak).where(Song.id == song_id).execute()
+
+    if results:
+        log.info("Saved loudness for %s songs" % len(results))
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["analyze"]:
+        print "Usage: python ingest.py analyze"
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    analyze_library()
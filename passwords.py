@@ -0,0 +1,77 @@
+import threading
+import bcrypt
+
+from multiprocessing import TimeoutError
+from multiprocessing.pool import Pool
+
+# bcrypt work factor for new hashes, older hashes are upgraded on login
+BCRYPT_ROUNDS = 12
+
+# Processes hashing passwords, and how many more requests may wait for one
+HASH_PROCESSES = 2
+HASH_QUEUE_SIZE = 16
+
+# Seconds a request waits for its hash before giving up
+HASH_TIMEOUT = 10
+
+class HasherBusy(Exception): pass
+
+def hash_password(pw, rounds=BCRYPT_ROUNDS):
+    return bcrypt.hashpw(pw.encode('utf-8'), bcrypt.gensalt(rounds))
+
+def check_password(pw, hashed):
+    return bcrypt.hashpw(pw.encode('utf-8'), hashed.encode('utf-8')) == hashed.encode('utf-8')
+
+def hash_rounds(hashed):
+    """
+    Returns the work factor a hash was created with, hashes look like
+    `$2a$12$<salt and hash>`.
+    """
+    try:
+        return int(hashed.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+class PasswordHasher(object):
+    """
+    Runs bcrypt in a small process pool, so a burst of logins can't tie up
+    the request threads which also serve the player. At most `processes +
+    queue_size` hashes are in flight, callers past that get HasherBusy
+    straight away instead of queueing forever.
+    """
+    # serve.py swaps this for a gevent friendly pool
+    pool_class = Pool
+
+    def __init__(self, rounds=BCRYPT_ROUNDS, processes=HASH_PROCESSES, queue_size=HASH_QUEUE_SIZE):
+        self.rounds = rounds
+        self.processes = processes
+        self.slots = threading.BoundedSemaphore(processes + queue_size)
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if not self.pool:
+                self.pool = self.pool_class(self.processes)
+
+    def run(self, func, *args):
+        self.start()
+
+        if not self.slots.acquire(False):
+            raise HasherBusy()
+
+        try:
+            return self.pool.apply_async(func, args).get(HASH_TIMEOUT)
+        except TimeoutError:
+            raise HasherBusy()
+        finally:
+            self.slots.release()
+
+    def hash(self, pw):
+        return self.run(hash_password, pw, self.rounds)
+
+    def check(self, pw, hashed):
+        return self.run(check_password, pw, hashed)
+
+    def needs_rehash(self, hashed):
+        return hash_rounds(hashed) != self.rounds
@@ -0,0 +1,150 @@
+import logging, threading, socket, time
+from contextlib import contextmanager
+from Queue import LifoQueue, Empty
+
+from mpd import MPDClient, ConnectionError
+
+log = logging.getLogger(__name__)
+
+# Connections idle for longer than this are pinged before being handed out
+HEALTH_CHECK_INTERVAL = 30
+
+# Errors after which a connection can no longer be trusted
+CONNECTION_ERRORS = (ConnectionError, socket.error)
+
+class PoolExhausted(Exception): pass
+
+class MPDPool(object):
+    """
+    A small pool of MPD connections. python-mpd2 clients are not thread-safe,
+    so every request checks out a connection of its own for the duration of
+    the commands it sends.
+    """
+    def __init__(self, host, port=0, size=4, timeout=10, wait=5, retries=5, backoff=0.1, max_backoff=5):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.wait = wait
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.idle = LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def connect(self, retries=None):
+        """
+        Opens a new connection, retrying with an exponential backoff. When
+        `retries` is None the pool default is used, pass -1 to retry forever.
+        """
+        retries = self.retries if retries is None else retries
+        delay = self.backoff
+        attempt = 0
+
+        while True:
+            try:
+                cli = MPDClient()
+                cli.timeout = self.timeout
+                cli.idletimeout = None
+                cli.connect(self.host, self.port)
+                return cli
+            except CONNECTION_ERRORS:
+                attempt += 1
+                if retries >= 0 and attempt > retries:
+                    raise
+
+                log.warning("Failed to connect to MPD at %s, retrying in %ss" % (self.host, delay))
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+    def checkout(self):
+        deadline = time.time() + self.wait
+
+        while True:
+            try:
+                cli, last_used = self.idle.get_nowait()
+            except Empty:
+                cli = self.create()
+                if cli:
+                    return cli
+
+                try:
+                    cli, last_used = self.idle.get(timeout=max(deadline - time.time(), 0))
+                except Empty:
+                    raise PoolExhausted("No MPD connection became available in %ss" % self.wait)
+
+            # A discarded connection freed up a slot, try to fill it
+            if cli is None:
+                continue
+
+            if time.time() - last_used < HEALTH_CHECK_INTERVAL:
+                return cli
+
+            try:
+                cli.ping()
+                return cli
+            except CONNECTION_ERRORS:
+                log.info("Dropping dead MPD connection from the pool")
+                self.discard(cli)
+
+    def create(self):
+        """
+        Opens a new connection if the pool has room for one, returns None
+        otherwise.
+        """
+        with self.lock:
+            if self.created >= self.size:
+                return None
+            self.created += 1
+
+        try:
+            return self.connect()
+        except:
+            with self.lock:
+                self.created -= 1
+            raise
+
+    def checkin(self, cli):
+        self.idle.put((cli, time.time()))
+
+    def discard(self, cli):
+        with self.lock:
+            self.created -= 1
+
+        # Wakes up a checkout waiting on the queue, so it can connect instead
+        self.idle.put((None, None))
+
+        try:
+            cli.disconnect()
+        except CONNECTION_ERRORS:
+            pass
+
+    @contextmanager
+    def connection(self):
+        cli = self.checkout()
+        try:
+            yield cli
+        except CONNECTION_ERRORS:
+            self.discard(cli)
+            raise
+        except:
+            # Command errors leave the connection in a usable state
+            self.checkin(cli)
+            raise
+        else:
+            self.checkin(cli)
+
+    def execute(self, command, *args):
+        """
+        Runs a single command, retrying once on a fresh connection if the one
+        we were handed turned out to be dead.
+        """
+        try:
+            with self.connection() as cli:
+                return getattr(cli, command)(*args)
+        except CONNECTION_ERRORS:
+            log.warning("MPD connection lost during `%s`, retrying" % command)
+            with self.connection() as cli:
+                return getattr(cli, command)(*args)
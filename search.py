@@ -0,0 +1,67 @@
+import re, cgi
+
+from peewee import SQL
+
+from cache import LRUCache
+from db import BModel, Song, FTSSong, Playlist, FTSPlaylist, SNIPPET_START, SNIPPET_END
+
+# Results are also keyed on the index version, the TTL only matters for
+# changes made by other processes.
+CACHE = LRUCache(256, ttl=60)
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+def build_query(text):
+    """
+    Turns user input into an FTS MATCH expression where every word is a
+    prefix, so partial words match while the user is still typing.
+    """
+    return " ".join("%s*" % token for token in TOKEN_RE.findall(text))
+
+def highlight(snippet):
+    """
+    Escapes a snippet, which is made of user supplied tags and titles, and
+    only then marks its matched words with <b> tags.
+    """
+    return cgi.escape(snippet, quote=True).replace(
+        SNIPPET_START, "<b>").replace(SNIPPET_END, "</b>")
+
+def search_table(model, search_model, query, limit):
+    """
+    Runs a single ranked query joining the FTS hits onto `model`, returning
+    fully serialized results.
+    """
+    rows = model.select(
+        model,
+        search_model.weighted_rank().alias("score"),
+        search_model.snippet().alias("snippet")
+    ).join(
+        search_model, on=(getattr(search_model, model.__name__.lower()) == model.id)
+    ).where(
+        search_model.match(query)
+    ).order_by(SQL("score").desc()).limit(limit)
+
+    results = []
+    for row in rows:
+        result = row.to_dict()
+        result["score"] = row.score
+        result["snippet"] = highlight(row.snippet)
+        results.append(result)
+    return results
+
+def search(text, limit=25):
+    query = build_query(text)
+    if not query:
+        return {"songs": [], "playlists": []}
+
+    key = (BModel.search_version, query, limit)
+    results = CACHE.get(key)
+
+    if results is None:
+        results = {
+            "songs": search_table(Song, FTSSong, query, limit),
+            "playlists": search_table(Playlist, FTSPlaylist, query, limit)
+        }
+        CACHE.set(key, results)
+
+    return results
@@ -0,0 +1,116 @@
+"""
+Production entry point, serves the app with gevent's WSGI server.
+
+    python serve.py [--host 0.0.0.0] [--port 3000] [--workers 1000]
+
+Everything is monkey patched before the app is imported, so MPD sockets,
+locks, queues and the SSE streams all yield to other requests instead of
+blocking. SQLite calls can't be made cooperative, but peewee's thread locals
+become greenlet locals, so each request still gets its own connection and
+queries are short enough not to matter. `--workers` caps how many requests
+are handled at once, every worker is a greenlet in this one process, which
+keeps the single MPD listener and the ingest jobs shared by all requests.
+
+SIGTERM and SIGINT stop accepting connections and give in-flight requests
+`--grace` seconds to finish.
+"""
+from gevent import monkey
+# gevent 1.0 leaves subprocess alone unless asked, ffmpeg would block the hub
+monkey.patch_all(subprocess=True)
+
+import os, sys, signal, logging, argparse
+import gevent, gevent.pool, gevent.threadpool
+
+from gevent.pywsgi import WSGIServer
+from multiprocessing import TimeoutError
+
+import app
+from db import MUSIC_DIR
+from ingest import Ingester
+from passwords import PasswordHasher
+
+log = logging.getLogger(__name__)
+
+# Requests handled at once
+WORKERS = 1000
+
+# Seconds in-flight requests get to finish on shutdown
+GRACEFUL_TIMEOUT = 10
+
+class CooperativeResult(object):
+    def __init__(self, greenlet):
+        self.greenlet = greenlet
+
+    def get(self, timeout=None):
+        try:
+            return self.greenlet.get(timeout=timeout)
+        except gevent.Timeout:
+            raise TimeoutError()
+
+class CooperativePool(object):
+    """
+    Stands in for multiprocessing.Pool once gevent has patched threading, its
+    result handler thread would otherwise block the whole hub on a pipe read.
+    Only the `apply` and `apply_async` calls the app makes are supported.
+    """
+    pool_class = gevent.pool.Pool
+
+    def __init__(self, processes):
+        self.pool = self.pool_class(processes)
+
+    def apply(self, func, args=()):
+        return self.pool.apply(func, args)
+
+    def apply_async(self, func, args=()):
+        return CooperativeResult(self.pool.apply_async(func, args))
+
+class NativeThreadPool(CooperativePool):
+    """
+    bcrypt is CPU bound C code which releases the GIL, so it runs in real
+    threads next to the hub rather than in greenlets.
+    """
+    pool_class = gevent.threadpool.ThreadPool
+
+# Loudness analysis spends its time in ffmpeg, which the patched subprocess
+# module waits on cooperatively.
+Ingester.pool_class = CooperativePool
+PasswordHasher.pool_class = NativeThreadPool
+
+def serve(host, port, workers, grace):
+    application = app.create_app()
+    # Scan for speakers now, rather than on the first Sonos request
+    application.sonos.start()
+
+    server = WSGIServer((host, port), application,
+        spawn=gevent.pool.Pool(workers), log=None)
+
+    def shutdown():
+        log.info("Shutting down, waiting up to %ss for requests to finish" % grace)
+        server.stop(timeout=grace)
+
+    # gevent 1.0 calls this gevent.signal, newer versions gevent.signal_handler
+    handle_signal = getattr(gevent, "signal_handler", None) or gevent.signal
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        handle_signal(signum, shutdown)
+
+    log.info("Serving on %s:%s with %s workers" % (host, port, workers))
+    server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve juicebox with gevent")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=3000)
+    parser.add_argument("--workers", type=int, default=WORKERS, help="requests handled at once")
+    parser.add_argument("--grace", type=int, default=GRACEFUL_TIMEOUT, help="seconds to finish requests on shutdown")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    if not os.path.exists(MUSIC_DIR):
+        print "Invalid MUSIC_DIR path `%s`!" % MUSIC_DIR
+        sys.exit(1)
+
+    serve(args.host, args.port, args.workers, args.grace)
+
+if __name__ == "__main__":
+    main()
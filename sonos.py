@@ -0,0 +1,83 @@
+import time, logging, threading
+import soco
+
+log = logging.getLogger(__name__)
+
+# Seconds between discovery scans, and how long each scan listens for replies
+DISCOVERY_INTERVAL = 60
+DISCOVERY_TIMEOUT = 5
+
+class SonosRegistry(object):
+    """
+    Keeps the list of Sonos speakers on the network, refreshed by a background
+    thread so requests never wait on a multicast scan, apart from lookups made
+    before the first one has finished. SoCo instances of the
+    discovered speakers are cached by IP. `interface_addr` can point discovery
+    at a fake UPnP responder (see bench/sonos.py), and `discover` can replace
+    the scan entirely.
+    """
+    def __init__(self, interval=DISCOVERY_INTERVAL, timeout=DISCOVERY_TIMEOUT,
+            interface_addr=None, discover=soco.discover):
+        self.interval = interval
+        self.timeout = timeout
+        self.interface_addr = interface_addr
+        self.discover = discover
+
+        # Player name -> IP, as of the last scan
+        self.players = {}
+        self.refreshed = None
+
+        self.speakers = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+        # Set once the first scan is over, whether it found anything or not
+        self.scanned = threading.Event()
+
+    def start(self):
+        with self.lock:
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                log.exception("Sonos discovery failed")
+            self.scanned.set()
+            time.sleep(self.interval)
+
+    def refresh(self):
+        found = self.discover(timeout=self.timeout, interface_addr=self.interface_addr) or []
+
+        # player_name is a network call, so only make it here and not per request
+        players = {}
+        for speaker in found:
+            players[speaker.player_name] = speaker.ip_address
+
+        with self.lock:
+            self.speakers = dict((i.ip_address, i) for i in found)
+            self.players = players
+            self.refreshed = time.time()
+
+        log.debug("Discovered %s Sonos speakers" % len(players))
+
+    def list(self):
+        self.start()
+        with self.lock:
+            return dict(self.players), self.refreshed
+
+    def get(self, ip):
+        """
+        Returns the speaker at `ip`, or None if the last scan didn't find one
+        there. Right after startup this waits for the first scan, which takes
+        `timeout` plus a topology lookup, rather than turning every speaker
+        away.
+        """
+        self.start()
+        self.scanned.wait(self.timeout * 2)
+        with self.lock:
+            return self.speakers.get(ip)
@@ -73,12 +73,74 @@ $(function() {
     },
     update_status: function() {
       var _this = this;
-      $.getJSON(this.urlRoot + '/status').success(function(data) {
-        _this.mpd_playlist = data.playlist;
-        delete data.playlist
+      var params = { since: this.mpd_status.version };
+      if (this.playlist_version !== undefined) {
+        params.playlist = this.playlist_version;
+      }
+      $.getJSON(this.urlRoot + '/status', params).success(function(data) {
+        // A 304 means nothing changed since our last version
+        if (!data) {
+          return;
+        }
+        if (data.queue) {
+          _this.apply_queue(data.queue);
+          delete data.queue;
+        }
         _this.mpd_status = data;
+        _this.status_received = Date.now();
+      });
+    },
+    fetch_queue: function() {
+      var _this = this;
+      $.getJSON(this.urlRoot + '/queue', { offset: 0 }).success(function(data) {
+        _this.mpd_playlist = data.queue;
+        _this.playlist_version = data.version;
       });
     },
+    apply_queue: function(diff) {
+      var _this = this;
+      if (diff.from === null || diff.from === undefined) {
+        this.mpd_playlist = diff.changes;
+      } else if (diff.from != this.playlist_version) {
+        // We missed a version somewhere, start over from a fresh page
+        this.fetch_queue();
+        return;
+      } else {
+        _.each(diff.changes, function(entry) {
+          _this.mpd_playlist[parseInt(entry.pos)] = entry;
+        });
+      }
+      this.mpd_playlist = this.mpd_playlist.slice(0, diff.length);
+      this.playlist_version = diff.version;
+    },
+    apply_event: function(data) {
+      if (data.player) {
+        this.mpd_status = data.player;
+        this.status_received = Date.now();
+      }
+      if (data.playlist) {
+        this.apply_queue(data.playlist);
+      }
+      if (data.mixer) {
+        this.mpd_status.volume = data.mixer.volume;
+      }
+    },
+    listen: function(callback) {
+      var _this = this;
+      this.events = new EventSource(this.urlRoot + '/events');
+      this.events.onmessage = function(e) {
+        _this.apply_event(JSON.parse(e.data));
+        callback();
+      };
+    },
+    elapsed: function() {
+      // The server only tells us about state changes, so extrapolate the play time
+      var elapsed = parseFloat(this.mpd_status.elapsed || 0);
+      if (this.mpd_status.state == 'play' && this.status_received) {
+        elapsed += (Date.now() - this.status_received) / 1000;
+      }
+      return Math.min(elapsed, parseFloat(this.mpd_status.time || elapsed));
+    },
     update_status_synch: function() {
       var _this = this;
       $.ajax({
@@ -86,9 +148,8 @@ $(function() {
         url: this.urlRoot + '/status',
         async: false,
         success: function(data) {
-          _this.mpd_playlist = data.playlist;
-          delete data.playlist
           _this.mpd_status = data;
+          _this.status_received = Date.now();
         }
       });
     }
@@ -100,12 +161,16 @@ $(function() {
       this.player = new Player();
       this.mpd_template = _.template($('#mpd_template').html());
       this.player.update_status_synch();
+      this.player.fetch_queue();
     },
     render: function() {
       var _this = this;
       var current_state = _this.player.mpd_status.state;
+      var now_playing = _.extend({}, _this.player.mpd_status, {
+        elapsed: _this.player.elapsed()
+      });
       $(this.el).html(this.mpd_template({
-        now_playing: _this.player.mpd_status,
+        now_playing: now_playing,
         playlist: _this.player.mpd_playlist
       }));
 
@@ -116,12 +181,10 @@ $(function() {
       } else if (current_state == 'stop' || current_state == 'pause') {
         $('.fa-' + current_state).css('color', 'red');
       }
-      $('#timeslider').val(_this.player.mpd_status.elapsed);
+      $('#timeslider').val(now_playing.elapsed);
       $(this.el).find('.control_link').on('click', function(e) {
         var operation = e.target.dataset.operation;
         _this.player[operation]();
-        _this.player.update_status();
-        _this.render();
       });
       $('#timeslider').on('change', function() {
         _this.player.seek($('#timeslider').val());
@@ -146,10 +209,23 @@ $(function() {
   window.PlayerApp = new PlayerView();
   PlayerApp.render();
 
-  setInterval(function() {
-    PlayerApp.player.update_status();
-    PlayerApp.render();
-  }, 1000);
+  if (window.EventSource) {
+    PlayerApp.player.listen(function() {
+      PlayerApp.render();
+    });
+
+    // Only the clock needs to tick locally, everything else is pushed to us
+    setInterval(function() {
+      if (PlayerApp.player.mpd_status.state == 'play') {
+        PlayerApp.render();
+      }
+    }, 1000);
+  } else {
+    setInterval(function() {
+      PlayerApp.player.update_status();
+      PlayerApp.render();
+    }, 1000);
+  }
 
   $('body').on('keyup', function(e) {
     if (e.keyCode == 32) {